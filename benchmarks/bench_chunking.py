@@ -0,0 +1,68 @@
+"""Throughput of ChunkedExecutor against a simulated LogScale.
+
+    python benchmarks/bench_chunking.py [--latency 0.05] [--per-member 0.00002]
+
+Each simulated mutation costs a fixed round trip plus a per-member cost, and
+a small share of member ids are rejected to exercise the bisect path.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+# run from a checkout, without installing the package or setting PYTHONPATH
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logscalescim.chunking import ChunkedExecutor
+from logscalescim.membership import LOGSCALE_GQL_MUTATION_GROUP_ADD_USERS
+from logscalescim.tenants import LogScaleQueryError
+
+
+class SimulatedTenant:
+    def __init__(self, latency, per_member, bad, max_concurrency=8):
+        self.latency = latency
+        self.per_member = per_member
+        self.bad = bad
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.calls = 0
+
+    def execute(self, document, variable_values=None):
+        users = variable_values["input"]["users"]
+        with self.slots:
+            self.calls += 1
+            time.sleep(self.latency + self.per_member * len(users))
+        if self.bad.intersection(users):
+            raise LogScaleQueryError("User does not exist")
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--per-member", type=float, default=0.00002)
+    parser.add_argument("--bad-every", type=int, default=25000)
+    args = parser.parse_args()
+
+    print("members chunk parallel   calls  failed  seconds  members/s")
+    for members in (10_000, 50_000, 100_000):
+        users = [f"user{i:07d}" for i in range(members)]
+        bad = set(users[:: args.bad_every])
+        for chunk_size in (500, 1000, 2000):
+            for parallelism in (1, 4, 8):
+                tenant = SimulatedTenant(args.latency, args.per_member, bad)
+                executor = ChunkedExecutor(tenant, chunk_size, parallelism)
+                start = time.perf_counter()
+                result = executor.run(
+                    "group", LOGSCALE_GQL_MUTATION_GROUP_ADD_USERS, iter(users)
+                )
+                elapsed = time.perf_counter() - start
+                print(
+                    f"{members:7d} {chunk_size:5d} {parallelism:8d} {tenant.calls:7d} "
+                    f"{len(result.failed):7d} {elapsed:8.2f} {members / elapsed:10.0f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
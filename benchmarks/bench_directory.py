@@ -0,0 +1,129 @@
+"""Memory of the compact Directory against a dict-of-dicts copy of LogScale.
+
+    python benchmarks/bench_directory.py [--users 200000] [--groups 2000]
+
+Users and group members are decoded from JSON pages like the bridge would
+receive them, so the baseline holds separate string objects per response
+the way plain caching of query results does.
+"""
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+# run from a checkout, without installing the package or setting PYTHONPATH
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logscalescim.directory import Directory
+
+
+def random_id(rng):
+    return "".join(rng.choices(string.ascii_letters + string.digits, k=24))
+
+
+def pages(rows, size=500):
+    # each page is serialized and decoded on its own, as a paged query is
+    for start in range(0, len(rows), size):
+        yield json.loads(json.dumps(rows[start : start + size]))
+
+
+def generate(users, groups, members, seed=1):
+    rng = random.Random(seed)
+    domains = [f"dept{i}.example.com" for i in range(20)]
+    user_rows = []
+    for i in range(users):
+        first = rng.choice(["ana", "bo", "chen", "dev", "eli", "fay", "gus", "hal"])
+        username = f"{first}.{i}"
+        user_rows.append(
+            {
+                "id": random_id(rng),
+                "username": username,
+                "email": f"{username}@{rng.choice(domains)}",
+                "displayName": f"{first.title()} {i}",
+            }
+        )
+    group_rows = [
+        {
+            "id": random_id(rng),
+            "displayName": f"group-{i}",
+            "lookupName": random_id(rng),
+        }
+        for i in range(groups)
+    ]
+    memberships = {
+        group["id"]: [
+            user["id"] for user in rng.sample(user_rows, rng.randint(1, members * 2))
+        ]
+        for group in group_rows
+    }
+    return json.dumps(user_rows), json.dumps(group_rows), json.dumps(memberships)
+
+
+def build_baseline(user_json, group_json, member_json):
+    users = {}
+    for page in pages(json.loads(user_json)):
+        for user in page:
+            users[user["id"]] = user
+    groups = {}
+    for page in pages(json.loads(group_json)):
+        for group in page:
+            groups[group["id"]] = {**group, "members": set()}
+    for groupId, members in json.loads(member_json).items():
+        groups[groupId]["members"] = set(members)
+    return users, groups
+
+
+def build_compact(user_json, group_json, member_json):
+    directory = Directory()
+    for page in pages(json.loads(user_json)):
+        for user in page:
+            directory.add_user(
+                user["id"], user["username"], user["email"], user["displayName"]
+            )
+    for page in pages(json.loads(group_json)):
+        for group in page:
+            directory.add_group(group["id"], group["displayName"], group["lookupName"])
+    for groupId, members in json.loads(member_json).items():
+        directory.set_members(groupId, members)
+    return directory
+
+
+def measure(build, *args):
+    # timed on its own, tracemalloc slows down allocation heavy code
+    start = time.perf_counter()
+    build(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    built = build(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return built, current, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200_000)
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--members", type=int, default=500, help="mean group size")
+    args = parser.parse_args()
+
+    data = generate(args.users, args.groups, args.members)
+    memberships = sum(len(members) for members in json.loads(data[2]).values())
+    print(f"users={args.users} groups={args.groups} memberships={memberships}")
+    print("store       retained MB  peak MB  bytes/user  seconds")
+    for name, build in (("dicts", build_baseline), ("compact", build_compact)):
+        built, current, peak, elapsed = measure(build, *data)
+        print(
+            f"{name:10s} {current / 1e6:12.1f} {peak / 1e6:8.1f} "
+            f"{current / args.users:11.0f} {elapsed:8.2f}"
+        )
+        del built
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Cold start cost of the SCIM bridge.
+
+    python benchmarks/bench_importtime.py [--budget-ms 250]
+
+Runs ``python -X importtime`` in a fresh interpreter, prints the slowest
+modules pulled in by ``import logscalescim.app`` plus the time to build the
+app with create_app(), and exits non-zero when the total is over budget.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# the checkout the measured interpreter imports logscalescim from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = """
+import time
+start = time.perf_counter()
+import logscalescim.app
+imported = time.perf_counter()
+logscalescim.app.create_app()
+created = time.perf_counter()
+print(f"{(imported - start) * 1000:.1f} {(created - imported) * 1000:.1f}")
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=250.0)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=ROOT,
+    )
+
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        modules.append((int(cumulative), name.rstrip()))
+
+    print(f"{'cumulative ms':>13}  module")
+    for cumulative, name in sorted(modules, reverse=True)[: args.top]:
+        print(f"{cumulative / 1000:13.1f}  {name}")
+
+    imported, created = (float(value) for value in result.stdout.split())
+    total = imported + created
+    print(
+        f"\nimport {imported:.1f} ms, create_app {created:.1f} ms, total {total:.1f} ms"
+    )
+    print(f"budget {args.budget_ms:.1f} ms")
+    if total > args.budget_ms:
+        print("over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+# Picked up automatically by gunicorn from the working directory.
+import os
+
+# the dispatcher orders the LogScale calls of requests running side by side
+# in a worker, a sync worker only ever runs one request at a time
+worker_class = "gthread"
+threads = int(os.environ.get("LOGSCALE_SCIM_THREADS", "16"))
+
+
+def post_worker_init(worker):
+    # runs in each worker after fork, once the app has been loaded
+    from logscalescim import app
+
+    app.init_worker(worker.wsgi, workers=worker.cfg.workers)
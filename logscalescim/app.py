@@ -1,39 +1,63 @@
 import os
-from dotenv import load_dotenv
 
-load_dotenv()
+# only pay for python-dotenv when there is a .env file to load, it has to be
+# read before the logscalescim modules below pick up their settings
+if os.path.exists(".env"):
+    from dotenv import load_dotenv
 
-from flask import Flask, jsonify, make_response, request, Response
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from werkzeug.security import generate_password_hash, check_password_hash
+    load_dotenv(".env")
+
+from flask import Blueprint, Flask, g, jsonify, make_response, request, Response
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.local import LocalProxy
 from functools import wraps
 
 import sys
 
-from gql import Client, gql
-from gql.transport.exceptions import TransportQueryError
-from gql.transport.requests import RequestsHTTPTransport
-
+import io
+import json
 import logging
 
-root = logging.getLogger()
-root.setLevel(logging.DEBUG)
-
-handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-handler.setFormatter(formatter)
-root.addHandler(handler)
+from logscalescim import calls, idempotency
+from logscalescim.auth import tokens
+from logscalescim.cache import start_invalidation
+from logscalescim.chunking import MembershipError
+from logscalescim.directory import (
+    LOGSCALE_GQL_MUTATION_GROUP_ADD,
+    LOGSCALE_GQL_MUTATION_USER_ADD,
+    directory_for,
+)
+from logscalescim.dispatch import classify, dispatcher
+from logscalescim.mapping import GROUP, USER, applied_hash, store, unchanged
+from logscalescim.profiling import TimedJSONProvider, TimedStreamHandler, profiler
+from logscalescim.membership import (
+    LOGSCALE_GQL_MUTATION_GROUP_ADD_USERS,
+    LOGSCALE_GQL_MUTATION_GROUP_REMOVE_USERS,
+    forget_members,
+    replace_members,
+    update_members,
+)
+from logscalescim.reconcile import start_verifier
+from logscalescim.streaming import (
+    LOGSCALE_SCIM_MAX_CONTENT_LENGTH,
+    StreamError,
+    iter_patch_operations,
+    read_group,
+)
+from logscalescim.tenants import (
+    DEFAULT_TENANT,
+    CircuitOpen,
+    LogScaleQueryError,
+    TenantPathMiddleware,
+    UnknownTenant,
+    document as gql,
+    tenants,
+)
+from logscalescim.warmer import start_warmer, warm_errors, warmed
 
 LOGSCALE_SCIM_PATH_PREFIX = "/api/ext/scim/v2"
+LOGSCALE_SCIM_OTEL = os.environ.get("LOGSCALE_SCIM_OTEL", "true").lower() == "true"
 
-LOGSCALE_GQL_MUTATION_GROUP_ADD = """mutation AddGroup($displayName: String!, $lookupName: String) {
-  addGroup(displayName: $displayName, lookupName: $lookupName) {
-    group {
-      id
-    }
-  }
-}"""
 LOGSCALE_GQL_MUTATION_GROUP_UPDATE = """mutation UpdateGroup($input: UpdateGroupInput!) {
   updateGroup(input: $input) {
     group {
@@ -52,23 +76,6 @@ LOGSCALE_GQL_MUTATION_GROUP_DELETE = """mutation RemoveGroup($groupId: String!)
   }
 }"""
 
-LOGSCALE_GQL_MUTATION_GROUP_ADD_USERS = """mutation AddUsersToGroup($input: AddUsersToGroupInput!) {
-  addUsersToGroup(input: $input) {
-    group {
-      id
-      lookupName
-    }
-  }
-}"""
-
-LOGSCALE_GQL_MUTATION_GROUP_REMOVE_USERS = """mutation RemoveUsersFromGroup($input: RemoveUsersFromGroupInput!) {
-  removeUsersFromGroup(input: $input) {
-    group {
-      id
-    }
-  }
-}"""
-
 
 LOGSCALE_GQL_MUTATION_USER_UPDATE_BY_ID = """mutation UpdateUserById($input: UpdateUserByIdInput!) {
   updateUserById(input: $input) {
@@ -77,13 +84,6 @@ LOGSCALE_GQL_MUTATION_USER_UPDATE_BY_ID = """mutation UpdateUserById($input: Upd
     }
   }
 }"""
-LOGSCALE_GQL_MUTATION_USER_ADD = """mutation AddUserV2($input: AddUserInputV2!) {
-  addUserV2(input: $input) {
-    ... on User {
-      id
-    }
-  }
-}"""
 
 LOGSCALE_GQL_MUTATION_USER_REMOVE = """mutation RemoveUserById($input: RemoveUserByIdInput!) {
   removeUserById(input: $input) {
@@ -107,33 +107,15 @@ LOGSCALE_GQL_QUERY_GROUP_BY_ID = """query Group($groupId: String!) {
   }
 }"""
 
-LOGSCALE_API_TOKEN = os.environ.get(
-    "LOGSCALE_API_TOKEN",
-    "",
-)
-LOGSCALE_URL = os.environ.get(
-    "LOGSCALE_URL", ""
-)
-SCIM_TOKEN  = os.environ.get(
-    "SCIM_TOKEN", ""
-)
-application = Flask(__name__)
-app = application
-
-FlaskInstrumentor().instrument_app(app)
+scim = Blueprint("scim", __name__)
 
 filter_regex = r"\"?(.*)\"?$"
 
-headers = {"Authorization": f"Bearer {LOGSCALE_API_TOKEN}"}
-
-transport = RequestsHTTPTransport(
-    url=LOGSCALE_URL, verify=False, retries=3, headers=headers
-)
+# resolves to the Tenant selected by token_required for the current request
+logscaleClient = LocalProxy(lambda: g.tenant)
 
-logscaleClient = Client(transport=transport, fetch_schema_from_transport=False)
 
-
-@app.errorhandler(Exception)
+@scim.app_errorhandler(Exception)
 def handle_exception(e):
     # log the exception
     logging.exception("Exception occurred")
@@ -141,6 +123,43 @@ def handle_exception(e):
     return make_response(jsonify({"exception": e}), 500)
 
 
+@scim.app_errorhandler(calls.CallBudgetExceeded)
+def handle_call_budget(e):
+    logging.error(f"{e} {dict(e.context.operations)}")
+    return scim_error(400, str(e))
+
+
+@scim.app_errorhandler(CircuitOpen)
+def handle_circuit_open(e):
+    return scim_error(503, str(e), {"Retry-After": str(int(e.retry_after) + 1)})
+
+
+@scim.app_errorhandler(RequestEntityTooLarge)
+def handle_too_large(e):
+    return scim_error(
+        413, f"Request body is larger than {LOGSCALE_SCIM_MAX_CONTENT_LENGTH} bytes"
+    )
+
+
+@scim.app_errorhandler(StreamError)
+def handle_stream_error(e):
+    return scim_error(400, f"Invalid request body: {e}")
+
+
+def scim_error(status, detail, headers=None):
+    # built without jsonify so rejected requests stay cheap
+    body = json.dumps(
+        {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+            "status": str(status),
+            "detail": detail,
+        }
+    )
+    return Response(
+        body, status=status, headers=headers, mimetype="application/scim+json"
+    )
+
+
 def token_required(f):
     @wraps(f)
     def decorator(*args, **kwargs):
@@ -151,16 +170,190 @@ def token_required(f):
             token = request.headers["x-access-tokens"]
 
         if not token:
-            return jsonify({"message": "a valid token is missing"})
+            return scim_error(
+                401, "a valid token is missing", {"WWW-Authenticate": "Bearer"}
+            )
+
+        # the body is not read until the handler runs, so invalid or
+        # throttled requests are rejected before any parsing happens
+        with calls.phase("auth"):
+            context = tokens.authenticate(token)
+            if context is None:
+                return scim_error(401, "Invalid token", {"WWW-Authenticate": "Bearer"})
+
+            wait = context.throttle()
+            if wait:
+                logging.warning(f"Rate limit exceeded for token {context.name}")
+                return scim_error(
+                    429, "Too many requests", {"Retry-After": str(int(wait) + 1)}
+                )
+
+            try:
+                g.tenant = tenants.get(
+                    tenants.resolve(context, request.environ.get("logscalescim.tenant"))
+                )
+            except PermissionError:
+                return scim_error(403, "Token is not valid for this tenant")
+            except UnknownTenant:
+                return scim_error(404, "Unknown tenant")
+
+        g.scim_token = context
+        if "priority" in context.attributes and calls.current.get() is not None:
+            calls.current.get().priority = classify(
+                request.method, token_priority=context.attributes["priority"]
+            )
+        return f(context, *args, **kwargs)
+
+    return decorator
+
+
+def admin_required(f):
+    """Only let tokens with "admin": true in their configuration through."""
+
+    @wraps(f)
+    def decorator(context, *args, **kwargs):
+        if not context.attributes.get("admin"):
+            return scim_error(403, "An admin token is required")
+        return f(context, *args, **kwargs)
+
+    return decorator
 
-        if token == SCIM_TOKEN:
-            return f(jsonify({"message": "authorized"}), *args, **kwargs)
+
+def idempotent(f):
+    """Replay the stored response of a retried write instead of running it again.
+
+    Keyed by the Idempotency-Key header, or else by a fingerprint of the
+    token, method, path and body. A duplicate that arrives while the
+    original is running waits for it and gets its response. Only responses
+    to an Idempotency-Key are kept for later retries; once a fingerprinted
+    write finished, the same write is run again, as it may be meant to undo
+    a change made in between. 5xx and 429 responses are not kept, so the
+    IdP's retry runs again.
+    """
+
+    @wraps(f)
+    def decorator(context, *args, **kwargs):
+        header = request.headers.get("Idempotency-Key")
+        digest = None
+        length = request.content_length
+        # large or chunked bodies are left to stream and are not fingerprinted
+        if length is not None and length <= idempotency.LOGSCALE_IDEMPOTENCY_MAX_BODY:
+            g.body = request.get_data(cache=True)
+            digest = idempotency.body_hash(g.body)
+        if header:
+            key = f"key:{context.name}:{header}"
+            ttl = idempotency.LOGSCALE_IDEMPOTENCY_TTL
+        elif digest is not None:
+            key = idempotency.fingerprint(
+                context.name, g.tenant.name, request.method, request.path, digest
+            )
+            ttl = idempotency.LOGSCALE_IDEMPOTENCY_FINGERPRINT_TTL
         else:
-            raise Exception("Invalid token")
+            return f(context, *args, **kwargs)
+
+        cache = g.tenant.cache(
+            "idempotency", idempotency.LOGSCALE_IDEMPOTENCY_SLOT_SIZE
+        )
+        entry = idempotency.acquire(cache, key)
+        if entry is not None:
+            if entry["state"] == idempotency.PENDING:
+                return scim_error(409, "The original request is still in progress")
+            if header and digest and entry["bodyHash"] not in (None, digest):
+                return scim_error(
+                    422, "Idempotency-Key was already used with a different body"
+                )
+            logging.info(f"Replaying {request.method} {request.path}")
+            response = Response(
+                entry["body"], status=entry["status"], mimetype=entry["mimetype"]
+            )
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        try:
+            response = make_response(f(context, *args, **kwargs))
+        except BaseException:
+            idempotency.abandon(cache, key)
+            raise
+        if response.status_code >= 500 or response.status_code == 429:
+            idempotency.abandon(cache, key)
+        else:
+            idempotency.complete(
+                cache,
+                key,
+                {
+                    "status": response.status_code,
+                    "mimetype": response.mimetype,
+                    "body": response.get_data(as_text=True),
+                    "bodyHash": digest,
+                },
+                ttl,
+                keep=bool(header),
+            )
+        return response
 
     return decorator
 
-@app.route("/", methods=["GET"])
+
+def request_stream():
+    """The request body as a stream, also when idempotent already read it."""
+    body = g.get("body")
+    return io.BytesIO(body) if body is not None else request.stream
+
+
+@scim.route("/healthz", methods=["GET"])
+def healthz():
+    """Liveness: the worker is serving requests, LogScale is not consulted."""
+    return make_response(jsonify({"status": "ok"}), 200)
+
+
+@scim.route("/readyz", methods=["GET"])
+def readyz():
+    """Readiness of this process: warmed up and able to take requests.
+
+    Each tenant's LogScale reachability, circuit and connection slots are
+    reported in the body but do not decide readiness, so one tenant's
+    outage does not take the replica out of rotation for all the others.
+    Only tenants in use are probed. Probes run in the background and are
+    cached, so the check answers at once and frequent checks do not turn
+    into LogScale traffic.
+    """
+    checks = {}
+    errors = warm_errors()
+    for name in tenants.configs:
+        tenant = tenants.active.get(name)
+        if tenant is None:
+            checks[name] = {"active": False}
+            continue
+        check = tenant.health()
+        check["warmError"] = errors.get(name)
+        check["active"] = True
+        check["ok"] = (
+            check["reachable"]
+            and check["circuit"] != "open"
+            and not check["saturated"]
+            and check["warmError"] is None
+        )
+        checks[name] = check
+    ready = warmed()
+    if not ready:
+        status = "unavailable"
+    elif all(check.get("ok", True) for check in checks.values()):
+        status = "ready"
+    else:
+        status = "degraded"
+    return make_response(
+        jsonify(
+            {
+                "status": status,
+                "warm": ready,
+                "tenants": checks,
+            }
+        ),
+        200 if ready else 503,
+    )
+
+
+@scim.route("/", methods=["GET"])
 def get_root():
 
     response = make_response(
@@ -174,7 +367,8 @@ def get_root():
     response.mimetype = "application/scim+json"
     return response
 
-@app.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/ServiceProviderConfig", methods=["GET"])
+
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/ServiceProviderConfig", methods=["GET"])
 def get_service_provider_config():
     safecontext = {}
     logging.info(safecontext)
@@ -186,7 +380,11 @@ def get_service_provider_config():
                     "urn:ietf:params:scim:schemas:core:2.0:ServiceProviderConfig"
                 ],
                 "patch": {"supported": True},
-                "bulk": {"supported": True, "maxOperations": 10, "maxPayloadSize": 0},
+                "bulk": {
+                    "supported": True,
+                    "maxOperations": 10,
+                    "maxPayloadSize": LOGSCALE_SCIM_MAX_CONTENT_LENGTH,
+                },
                 "filter": {"supported": False, "maxResults": 25},
                 "changePassword": {"supported": False},
                 "sort": {"supported": False},
@@ -232,8 +430,103 @@ def user_not_found():
     return response
 
 
+def user_input(userdata):
+    """The LogScale user fields carried by a SCIM User resource."""
+    fields = {"fullName": userdata["name"]["formatted"]}
+    if "familyName" in userdata["name"]:
+        fields["lastName"] = userdata["name"]["familyName"]
+    if "givenName" in userdata["name"]:
+        fields["firstName"] = userdata["name"]["givenName"]
+    for email in userdata["emails"]:
+        if email["primary"]:
+            fields["email"] = email["value"]
+    return fields
+
+
+# SCIM User attributes, lower cased, and the LogScale user field they set
+USER_PATCH_FIELDS = {
+    "username": "username",
+    "name.formatted": "fullName",
+    "name.givenname": "firstName",
+    "name.familyname": "lastName",
+    "emails": "email",
+}
+# attributes that only the bridge keeps
+USER_PATCH_LOCAL = {"displayname": "displayName", "externalid": "externalId"}
+
+
+def user_patch_input(operations):
+    """Merge the operations of a User PatchOp into one update.
+
+    Returns the LogScale user fields to set, the displayName and externalId
+    that are only kept by the bridge, and the new value of "active" if an
+    operation sets it. Attributes LogScale has no field for are ignored,
+    like they are on PUT.
+    """
+    fields = {}
+    local = {}
+    active = None
+
+    def apply(op, path, value):
+        nonlocal active
+        # emails[type eq "work"].value and friends all mean the one email
+        attribute = path.lower().split("[")[0]
+        if attribute == "name" and isinstance(value, dict):
+            for key, part in value.items():
+                apply(op, f"name.{key}", part)
+        elif attribute == "active":
+            if isinstance(value, str):
+                value = value.lower() == "true"
+            active = bool(value)
+        elif attribute in USER_PATCH_LOCAL:
+            local[USER_PATCH_LOCAL[attribute]] = value
+        elif attribute in USER_PATCH_FIELDS:
+            if attribute == "emails" and isinstance(value, list):
+                primary = [email for email in value if email.get("primary")]
+                value = (primary or value or [{}])[0].get("value")
+            if op == "remove":
+                if attribute in ("username", "emails"):
+                    raise ValueError(f"{path} cannot be removed")
+                value = ""
+            fields[USER_PATCH_FIELDS[attribute]] = value
+        else:
+            logging.debug(f"Ignoring User PatchOp path {path}")
+
+    for operation in operations:
+        op = operation.get("op", "").lower()
+        if op not in ("add", "replace", "remove"):
+            raise ValueError(f"Unsupported PatchOp operation {operation.get('op')}")
+        path = operation.get("path")
+        if path:
+            apply(op, path, operation.get("value"))
+        elif isinstance(operation.get("value"), dict):
+            for key, value in operation["value"].items():
+                apply(op, key, value)
+        else:
+            raise ValueError("A PatchOp without a path needs an object value")
+    return fields, local, active
+
+
 def lookup_user_by_email(username, email):
 
+    cache = g.tenant.cache("users")
+    key = f"{email}|{username}"
+    existingID = cache.get(key)
+    if existingID is not None:
+        return existingID
+
+    directory = directory_for(g.tenant)
+    if directory.loaded:
+        found = directory.find_user(email, username)
+        if found is not None:
+            cache.remember(key, found)
+            return found
+
+    mapped = store.by_email(g.tenant.name, email, username)
+    if mapped is not None:
+        cache.remember(key, mapped["logscale_id"])
+        return mapped["logscale_id"]
+
     query = gql(
         """query Users($search: String) {
   users(search: $search) {id,username, email, displayName}
@@ -245,84 +538,95 @@ def lookup_user_by_email(username, email):
         logging.debug(result)
         for user in result["users"]:
             if user["email"] == email and user["username"] == username:
+                cache.remember(key, user["id"])
                 return user["id"]
         for user in result["users"]:
             if user["email"] == email:
+                cache.remember(key, user["id"])
                 return user["id"]
 
-    except TransportQueryError:
-        logging.exception("TransportQueryError")
+    except LogScaleQueryError:
+        logging.exception("LogScaleQueryError")
 
     return None
 
 
-@app.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Users", methods=["POST"])
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Users", methods=["POST"])
 @token_required
+@idempotent
 def user_post(context):
 
-    logging.debug(request.json)
     userdata = request.json
+    logging.debug(userdata)
     """
     {'userName': 'akadmin', 'name': {'formatted': 'authentik Default Admin', 'familyName': 'Default Admin', 'givenName': 'authentik'}, 'displayName': 'authentik Default Admin', 'active': True, 'emails': [{...}], 'schemas': ['urn:ietf:params:scim:schemas:core:2.0:User'], 'externalId': 'e89f4b0dcc531b703369420fbe0d6504b8f5c8a5fc419527358d07308a47b3c7'}
     """
 
     # [{'message': 'Variable \'$input\' expected value of type \'AddUserInputV2!\' but got: {"displayName":"authentik Default Admin","email":"ryan.faircloth@crowdstrike.com","firstName":"authentik","lastName":"Default Admin","username":"akadmin"}. Reason: \'displayName\' Field \'displayName\' is not defined in the input type \'AddUserInputV2\'. (line 1, column 20):\nmutation AddUserV2($input: AddUserInputV2!) {\n                   ^', 'locations': [...], 'isHumioUpdating': False}]
-    for email in userdata["emails"]:
-        if email["primary"]:
-            email = email["value"]
-
-    existingID = lookup_user_by_email(userdata["userName"], email)
-    if existingID:
-        resultkey = "updateUserById"
-        query = gql(LOGSCALE_GQL_MUTATION_USER_UPDATE_BY_ID)
-        params = {
-            "input": {"userId": existingID, "fullName": userdata["name"]["formatted"]}
-        }
-        if "familyName" in userdata["name"]:
-            params["input"]["lastName"] = userdata["name"]["familyName"]
-        if "givenName" in userdata["name"]:
-            params["input"]["firstName"] = userdata["name"]["givenName"]
-        for email in userdata["emails"]:
-            if email["primary"]:
-                params["input"]["email"] = email["value"]
-
-        try:
-            logging.debug(query)
-            result = logscaleClient.execute(query, variable_values=params)
-            logging.debug(result)
-
-        except TransportQueryError as e:
-            logging.exception("TransportQueryError")
-            return "", 500
-        id = result[resultkey]["user"]["id"]
+    fields = user_input(userdata)
+    email = fields.get("email")
+    state = applied_hash({**fields, "username": userdata["userName"]})
+
+    mapped = store.by_external_id(g.tenant.name, USER, userdata.get("externalId"))
+    if unchanged(mapped, state):
+        # unchanged since it was last applied, typical of periodic full pushes
+        id = mapped["logscale_id"]
     else:
-        resultkey = "addUserV2"
-        query = gql(LOGSCALE_GQL_MUTATION_USER_ADD)
+        if mapped is not None:
+            existingID = mapped["logscale_id"]
+        else:
+            existingID = lookup_user_by_email(userdata["userName"], email)
 
-        params = {
-            "input": {
-                "fullName": userdata["name"]["formatted"],
-                "username": userdata["userName"],
-            }
-        }
-        if "familyName" in userdata["name"]:
-            params["input"]["lastName"] = userdata["name"]["familyName"]
-        if "givenName" in userdata["name"]:
-            params["input"]["firstName"] = userdata["name"]["givenName"]
-        for email in userdata["emails"]:
-            if email["primary"]:
-                params["input"]["email"] = email["value"]
+        if existingID:
+            resultkey = "updateUserById"
+            query = gql(LOGSCALE_GQL_MUTATION_USER_UPDATE_BY_ID)
+            params = {"input": {"userId": existingID, **fields}}
 
-        try:
-            logging.debug(query)
-            result = logscaleClient.execute(query, variable_values=params)
-            logging.debug(result)
+            try:
+                logging.debug(query)
+                result = logscaleClient.execute(query, variable_values=params)
+                logging.debug(result)
+
+            except LogScaleQueryError as e:
+                logging.exception("LogScaleQueryError")
+                # the cached or mapped id may be stale, look it up again on the retry
+                g.tenant.cache("users").forget(existingID)
+                store.delete(g.tenant.name, USER, existingID)
+                directory_for(g.tenant).remove_user(existingID)
+                return "", 500
+            id = result[resultkey]["user"]["id"]
+        else:
+            resultkey = "addUserV2"
+            query = gql(LOGSCALE_GQL_MUTATION_USER_ADD)
 
-        except TransportQueryError as e:
-            logging.exception("TransportQueryError")
-            return "", 500
+            params = {"input": {"username": userdata["userName"], **fields}}
 
-        id = result[resultkey]["id"]
+            try:
+                logging.debug(query)
+                result = logscaleClient.execute(query, variable_values=params)
+                logging.debug(result)
+
+            except LogScaleQueryError as e:
+                logging.exception("LogScaleQueryError")
+                return "", 500
+
+            id = result[resultkey]["id"]
+
+        store.upsert(
+            g.tenant.name,
+            USER,
+            id,
+            external_id=userdata.get("externalId"),
+            user_name=userdata["userName"],
+            email=email,
+            display_name=userdata.get("displayName"),
+            applied_hash=state,
+        )
+        directory = directory_for(g.tenant)
+        if directory.loaded:
+            directory.add_user(
+                id, userdata["userName"], email, userdata.get("displayName")
+            )
 
     return make_response(
         jsonify(
@@ -342,44 +646,65 @@ def user_post(context):
     )
 
 
-@app.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Users/<id>", methods=["PUT"])
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Users/<id>", methods=["PUT"])
 @token_required
+@idempotent
 def user_put(context, *args, **kwargs):
 
-    logging.debug(request.json)
     userdata = request.json
+    logging.debug(userdata)
     """
     {'userName': 'akadmin', 'name': {'formatted': 'authentik Default Admin', 'familyName': 'Default Admin', 'givenName': 'authentik'}, 'displayName': 'authentik Default Admin', 'active': True, 'emails': [{...}], 'schemas': ['urn:ietf:params:scim:schemas:core:2.0:User'], 'externalId': 'e89f4b0dcc531b703369420fbe0d6504b8f5c8a5fc419527358d07308a47b3c7'}
     """
 
-    resultkey = "updateUserById"
-    query = gql(LOGSCALE_GQL_MUTATION_USER_UPDATE_BY_ID)
-    params = {
-        "input": {"userId": kwargs["id"], "fullName": userdata["name"]["formatted"]}
-    }
-    if "familyName" in userdata["name"]:
-        params["input"]["lastName"] = userdata["name"]["familyName"]
-    if "givenName" in userdata["name"]:
-        params["input"]["firstName"] = userdata["name"]["givenName"]
-    for email in userdata["emails"]:
-        if email["primary"]:
-            params["input"]["email"] = email["value"]
+    fields = user_input(userdata)
+    state = applied_hash({**fields, "username": userdata["userName"]})
+    mapped = store.by_logscale_id(g.tenant.name, USER, kwargs["id"])
 
-    try:
-        logging.debug(query)
-        result = logscaleClient.execute(query, variable_values=params)
-        logging.debug(result)
+    if not unchanged(mapped, state):
+        query = gql(LOGSCALE_GQL_MUTATION_USER_UPDATE_BY_ID)
+        params = {"input": {"userId": kwargs["id"], **fields}}
 
-    except TransportQueryError as e:
-        logging.exception("TransportQueryError")
-        return "", 500
+        try:
+            logging.debug(query)
+            result = logscaleClient.execute(query, variable_values=params)
+            logging.debug(result)
+
+        except LogScaleQueryError as e:
+            logging.exception("LogScaleQueryError")
+            return "", 500
+
+        # the email may have changed, drop the cached lookup for this user
+        g.tenant.cache("users").forget(kwargs["id"])
+        directory = directory_for(g.tenant)
+        if directory.loaded:
+            directory.add_user(
+                kwargs["id"],
+                userdata["userName"],
+                fields.get("email"),
+                userdata.get("displayName"),
+            )
+
+    externalId = userdata.get("externalId")
+    if externalId is None and mapped is not None:
+        externalId = mapped["external_id"]
+    store.upsert(
+        g.tenant.name,
+        USER,
+        kwargs["id"],
+        external_id=externalId,
+        user_name=userdata["userName"],
+        email=fields.get("email"),
+        display_name=userdata.get("displayName"),
+        applied_hash=state,
+    )
 
     return make_response(
         jsonify(
             {
                 "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
-                "id": result[resultkey]["user"]["id"],
-                "externalId": kwargs["id"],
+                "id": kwargs["id"],
+                "externalId": externalId,
                 "meta": {
                     "location": f"{request.base_url}/Users/{kwargs['id']}",
                     "resourceType": "Group",
@@ -392,31 +717,109 @@ def user_put(context, *args, **kwargs):
     )
 
 
-@app.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Users/<id>", methods=["DELETE"])
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Users/<id>", methods=["PATCH"])
 @token_required
-def user_delete(context, *args, **kwargs):
+@idempotent
+def user_patch(context, *args, **kwargs):
+    """
+    {'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'], 'Operations': [{'op': 'replace', 'value': {'active': False}}]}
+    {'op': 'replace', 'path': 'name.givenName', 'value': 'Ana'}
+    """
+
+    try:
+        fields, local, active = user_patch_input(request.json.get("Operations", []))
+    except ValueError as e:
+        return scim_error(400, str(e))
+    logging.info(f"User {kwargs['id']} PatchOp {sorted(fields)} active={active}")
+
+    if active is False:
+        # deprovisioning, whatever else the PatchOp changes no longer matters
+        return remove_user(kwargs["id"])
+
+    # a user deprovisioned by active=false was removed from LogScale and
+    # cannot come back under its old id, the update tells whether it exists
+    check = (
+        active is True
+        and store.by_logscale_id(g.tenant.name, USER, kwargs["id"]) is None
+    )
+    if fields or check:
+        query = gql(LOGSCALE_GQL_MUTATION_USER_UPDATE_BY_ID)
+        params = {"input": {"userId": kwargs["id"], **fields}}
+
+        try:
+            logging.debug(query)
+            result = logscaleClient.execute(query, variable_values=params)
+            logging.debug(result)
+
+        except LogScaleQueryError as e:
+            logging.exception("LogScaleQueryError")
+            if check:
+                return scim_error(
+                    404, f"User {kwargs['id']} does not exist, create it again"
+                )
+            return "", 500
+
+        g.tenant.cache("users").forget(kwargs["id"])
+
+    directory = directory_for(g.tenant)
+    known = directory.user(kwargs["id"]) if directory.loaded else None
+    if known is not None:
+        directory.add_user(
+            kwargs["id"],
+            fields.get("username", known["username"]),
+            fields.get("email", known["email"]),
+            local.get("displayName", known["displayName"]),
+        )
+
+    store.upsert(
+        g.tenant.name,
+        USER,
+        kwargs["id"],
+        external_id=local.get("externalId"),
+        user_name=fields.get("username"),
+        email=fields.get("email"),
+        display_name=local.get("displayName"),
+        # only part of the user is known here, the next PUT applies it again
+        applied_hash="" if fields else None,
+    )
 
+    return "", 204
+
+
+def remove_user(id):
     query = gql(LOGSCALE_GQL_MUTATION_USER_REMOVE)
-    params = {"input": {"id": kwargs["id"]}}
+    params = {"input": {"id": id}}
 
     try:
         logging.debug(query)
         result = logscaleClient.execute(query, variable_values=params)
         logging.debug(result)
 
-    except TransportQueryError as e:
-        logging.exception("TransportQueryError")
+    except LogScaleQueryError as e:
+        logging.exception("LogScaleQueryError")
         return "", 500
 
+    g.tenant.cache("users").forget(id)
+    store.delete(g.tenant.name, USER, id)
+    directory_for(g.tenant).remove_user(id)
+
     return "", 204
 
 
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Users/<id>", methods=["DELETE"])
+@token_required
+@idempotent
+def user_delete(context, *args, **kwargs):
+    return remove_user(kwargs["id"])
+
+
 def get_group_by_id(id):
 
     params = {{"groupId": id}}
     logscaleClient.execute(gql(LOGSCALE_GQL_QUERY_GROUP_BY_ID), variable_values=params)
 
-@app.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Groups/<id>", methods=["GET"])
+
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Groups/<id>", methods=["GET"])
 @token_required
 def groups_get(context, *args, **kwargs):
     logging.info(request.json)
@@ -438,8 +841,8 @@ def groups_get(context, *args, **kwargs):
         result = logscaleClient.execute(query, variable_values=params)
         logging.debug(result)
 
-    except TransportQueryError:
-        logging.exception("TransportQueryError")
+    except LogScaleQueryError:
+        logging.exception("LogScaleQueryError")
         return "", 500
 
     return make_response(
@@ -459,16 +862,69 @@ def groups_get(context, *args, **kwargs):
         200,
     )
 
-@app.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Groups", methods=["POST"])
+
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Groups", methods=["POST"])
 @token_required
+@idempotent
 def groups_post(context):
 
-    logging.info(request.json)
     userdata = request.json
+    logging.info(userdata)
     """
     {'displayName': 'authentik Admins', 'schemas': ['urn:ietf:params:scim:schemas:core:2.0:Group'], 'externalId': '433a38d7-721c-424f-adb7-9ee1b8b87608'}
     """
 
+    state = applied_hash(
+        {"displayName": userdata["displayName"], "lookupName": userdata["externalId"]}
+    )
+    mapped = store.by_external_id(g.tenant.name, GROUP, userdata["externalId"])
+    if mapped is not None:
+        # known group, skip the addGroup that would fail with GroupNameMustBeUnique
+        groupId = mapped["logscale_id"]
+        if not unchanged(mapped, state):
+            params = {
+                "input": {
+                    "groupId": groupId,
+                    "displayName": userdata["displayName"],
+                    "lookupName": userdata["externalId"],
+                }
+            }
+            query = gql(LOGSCALE_GQL_MUTATION_GROUP_UPDATE)
+            try:
+                result = logscaleClient.execute(query, variable_values=params)
+                logging.debug(result)
+
+            except LogScaleQueryError:
+                logging.exception("LogScaleQueryError")
+                store.delete(g.tenant.name, GROUP, groupId)
+                return "", 500
+
+            store.upsert(
+                g.tenant.name,
+                GROUP,
+                groupId,
+                external_id=userdata["externalId"],
+                display_name=userdata["displayName"],
+                applied_hash=state,
+            )
+
+        return make_response(
+            jsonify(
+                {
+                    "schemas": ["urn:ietf:params:scim:schemas:core:2.0:Group"],
+                    "id": groupId,
+                    "externalId": userdata["externalId"],
+                    "meta": {
+                        "location": f"{request.base_url}/Groups/{groupId}",
+                        "resourceType": "Group",
+                        "created": "2024-10-06T00:00Z",
+                        "lastModified": "2024-10-06T00:00Z",
+                    },
+                }
+            ),
+            200,
+        )
+
     params = {
         "displayName": userdata["displayName"],
         "lookupName": userdata["externalId"],
@@ -480,20 +936,25 @@ def groups_post(context):
         result = logscaleClient.execute(query, variable_values=params)
         logging.debug(result)
 
-    except TransportQueryError as e:
+    except LogScaleQueryError as e:
         if e.errors[0]["path"] == ["addGroup"]:
             if e.errors[0]["errorCode"] == "GroupNameMustBeUnique":
 
                 # get the ID of the existing group
-                params = {
-                    "displayName": userdata["displayName"],                    
-                }
-                query = gql(LOGSCALE_GQL_QUERY_GROUP_BY_DISPLAY_NAME)
-                result = logscaleClient.execute(query, variable_values=params)
-                    
+                cache = g.tenant.cache("groups")
+                groupId = cache.get(userdata["displayName"])
+                if groupId is None:
+                    params = {
+                        "displayName": userdata["displayName"],
+                    }
+                    query = gql(LOGSCALE_GQL_QUERY_GROUP_BY_DISPLAY_NAME)
+                    result = logscaleClient.execute(query, variable_values=params)
+                    groupId = result["groupByDisplayName"]["id"]
+                    cache.remember(userdata["displayName"], groupId)
+
                 params = {
                     "input": {
-                        "groupId": result["groupByDisplayName"]["id"],
+                        "groupId": groupId,
                         "displayName": userdata["displayName"],
                         "lookupName": userdata["externalId"],
                     }
@@ -506,6 +967,15 @@ def groups_post(context):
                     result = logscaleClient.execute(query, variable_values=params)
                     logging.debug(result)
 
+                    store.upsert(
+                        g.tenant.name,
+                        GROUP,
+                        groupId,
+                        external_id=userdata["externalId"],
+                        display_name=userdata["displayName"],
+                        applied_hash=state,
+                    )
+
                     return make_response(
                         jsonify(
                             {
@@ -523,13 +993,26 @@ def groups_post(context):
                         200,
                     )
 
-                except TransportQueryError:
-                    logging.exception("TransportQueryError")
+                except LogScaleQueryError:
+                    logging.exception("LogScaleQueryError")
+                    cache.forget(groupId)
                     return "", 500
         else:
-            logging.exception("TransportQueryError")
+            logging.exception("LogScaleQueryError")
             return "", 500
 
+    g.tenant.cache("groups").remember(
+        userdata["displayName"], result["addGroup"]["group"]["id"]
+    )
+    store.upsert(
+        g.tenant.name,
+        GROUP,
+        result["addGroup"]["group"]["id"],
+        external_id=userdata["externalId"],
+        display_name=userdata["displayName"],
+        applied_hash=state,
+    )
+
     return make_response(
         jsonify(
             {
@@ -548,44 +1031,78 @@ def groups_post(context):
     )
 
 
-@app.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Groups/<id>", methods=["PUT"])
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Groups/<id>", methods=["PUT"])
 @token_required
+@idempotent
 def groups_put(context, *args, **kwargs):
     safecontext = {}
     logging.info(safecontext)
-    logging.info(request.json)
-    userdata = request.json
+    # members are reduced to their ids while the body is read
+    userdata = read_group(request_stream())
+    logging.info({key: value for key, value in userdata.items() if key != "members"})
     """
     {'id': 'hyKYMwxAUd54lnAc6i2TYI39jDBonrVV', 'displayName': 'authentik Admins', 'schemas': ['urn:ietf:params:scim:schemas:core:2.0:Group'], 'externalId': '433a38d7-721c-424f-adb7-9ee1b8b87608'}
     """
 
-    params = {
-        "input": {
-            "groupId": kwargs["id"],
-            "displayName": userdata["displayName"],
-            "lookupName": userdata["externalId"],
+    state = applied_hash(
+        {"displayName": userdata["displayName"], "lookupName": userdata["externalId"]}
+    )
+    mapped = store.by_logscale_id(g.tenant.name, GROUP, kwargs["id"])
+
+    if not unchanged(mapped, state):
+        params = {
+            "input": {
+                "groupId": kwargs["id"],
+                "displayName": userdata["displayName"],
+                "lookupName": userdata["externalId"],
+            }
         }
-    }
 
-    query = gql(LOGSCALE_GQL_MUTATION_GROUP_UPDATE)
+        query = gql(LOGSCALE_GQL_MUTATION_GROUP_UPDATE)
 
-    try:
+        try:
 
-        result = logscaleClient.execute(query, variable_values=params)
-        logging.debug(result)
+            result = logscaleClient.execute(query, variable_values=params)
+            logging.debug(result)
 
-    except TransportQueryError:
-        logging.exception("TransportQueryError")
-        return "", 500
+        except LogScaleQueryError:
+            logging.exception("LogScaleQueryError")
+            return "", 500
+
+        cache = g.tenant.cache("groups")
+        cache.forget(kwargs["id"])
+        cache.remember(userdata["displayName"], kwargs["id"])
+        store.upsert(
+            g.tenant.name,
+            GROUP,
+            kwargs["id"],
+            external_id=userdata["externalId"],
+            display_name=userdata["displayName"],
+            applied_hash=state,
+        )
+
+    # full replace semantics, only present when the IdP sends members
+    if "members" in userdata:
+        desired = userdata["members"]
+        try:
+            to_add, to_remove = replace_members(g.tenant, kwargs["id"], desired)
+            if to_add or to_remove:
+                store.touch(g.tenant.name, GROUP, kwargs["id"])
+        except LogScaleQueryError:
+            logging.exception("LogScaleQueryError")
+            return "", 500
+        except MembershipError as e:
+            logging.error(f"Group {kwargs['id']} {e}")
+            return scim_error(500, str(e))
 
     return make_response(
         jsonify(
             {
                 "schemas": ["urn:ietf:params:scim:schemas:core:2.0:Group"],
-                "id": result["updateGroup"]["group"]["id"],
+                "id": kwargs["id"],
                 "externalId": userdata["externalId"],
                 "meta": {
-                    "location": f"{request.base_url}/Groups/{result['updateGroup']['group']['id']}",
+                    "location": f"{request.base_url}/Groups/{kwargs['id']}",
                     "resourceType": "Group",
                     "created": "2024-10-06T00:00Z",
                     "lastModified": "2024-10-06T00:00Z",
@@ -596,13 +1113,12 @@ def groups_put(context, *args, **kwargs):
     )
 
 
-@app.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Groups/<id>", methods=["PATCH"])
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Groups/<id>", methods=["PATCH"])
 @token_required
+@idempotent
 def groups_patch(context, *args, **kwargs):
     safecontext = {}
     logging.info(safecontext)
-    logging.info(request.json)
-    userdata = request.json
     """
     {'Operations': [{...}], 'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp']}
     [{'op': 'replace', 'path': 'displayName', 'value': 'weka2-logscale-usersx'}]
@@ -614,35 +1130,68 @@ def groups_patch(context, *args, **kwargs):
         {"op": "add", "path": "members", "value": [{"value": "b0PWHGSfJGY97Cjd37eQ81nv"}]}, {"op": "add", "path": "members", "value": [{"value": "BTckjpsawMXSMJZf0PbQUQMJ"}]}], "schemas": ["urn:ietf:params:scim:api:messages:2.0:PatchOp"]}
     """
 
-    # for operation in userdata['Operations']
-    for operation in userdata["Operations"]:
+    # operations are read from the body one at a time, member lists are
+    # streamed into the chunked mutations rather than decoded up front
+    for operation in iter_patch_operations(request_stream()):
+        logging.info(
+            f"Group {kwargs['id']} PatchOp {operation.get('op')} {operation.get('path')}"
+        )
         params = {
             "input": {
                 "groupId": kwargs["id"],
             }
         }
-        if operation["op"] == "replace":
+        if operation["op"] == "replace" and operation.get("path") == "members":
+            desired = {value["value"] for value in operation["value"]}
+            try:
+                to_add, to_remove = replace_members(g.tenant, kwargs["id"], desired)
+                if to_add or to_remove:
+                    store.touch(g.tenant.name, GROUP, kwargs["id"])
+            except LogScaleQueryError:
+                logging.exception("LogScaleQueryError")
+                return "", 500
+            except MembershipError as e:
+                logging.error(f"Group {kwargs['id']} {e}")
+                return scim_error(500, str(e))
+            continue
+        elif operation["op"] == "replace":
             resultkey = "updateGroup"
             query = gql(LOGSCALE_GQL_MUTATION_GROUP_UPDATE)
             if "displayName" in operation["value"]:
                 params["input"]["displayName"] = operation["value"]["displayName"]
+                g.tenant.cache("groups").forget(kwargs["id"])
 
             if "externalId" in operation["value"]:
                 params["input"]["lookupName"] = operation["value"]["externalId"]
-        elif operation["op"] == "add" and operation["path"] == "members":
-            resultkey = "addUsersToGroup"
-            query = gql(LOGSCALE_GQL_MUTATION_GROUP_ADD_USERS)
-            params["input"]["groupId"] = kwargs["id"]
-            params["input"]["users"] = []
-            for value in operation["value"]:
-                params["input"]["users"].append(value["value"])
-        elif operation["op"] == "remove" and operation["path"] == "members":
-            resultkey = "addUsersToGroup"
-            query = gql(LOGSCALE_GQL_MUTATION_GROUP_REMOVE_USERS)
-            params["input"]["groupId"] = kwargs["id"]
-            params["input"]["users"] = []
-            for value in operation["value"]:
-                params["input"]["users"].append(value["value"])
+
+            # a partial update, clear the hash so the next PUT is applied
+            store.upsert(
+                g.tenant.name,
+                GROUP,
+                kwargs["id"],
+                external_id=params["input"].get("lookupName"),
+                display_name=params["input"].get("displayName"),
+                applied_hash="",
+            )
+        elif operation["op"] in ("add", "remove") and operation["path"] == "members":
+            if operation["op"] == "add":
+                mutation = LOGSCALE_GQL_MUTATION_GROUP_ADD_USERS
+            else:
+                mutation = LOGSCALE_GQL_MUTATION_GROUP_REMOVE_USERS
+            forget_members(g.tenant, kwargs["id"])
+            try:
+                update_members(
+                    g.tenant,
+                    kwargs["id"],
+                    mutation,
+                    (value["value"] for value in operation["value"]),
+                )
+            except MembershipError as e:
+                store.touch(g.tenant.name, GROUP, kwargs["id"])
+                logging.error(f"Group {kwargs['id']} {e}")
+                return scim_error(500, str(e))
+            store.touch(g.tenant.name, GROUP, kwargs["id"])
+            continue
         else:
             continue
 
@@ -650,15 +1199,16 @@ def groups_patch(context, *args, **kwargs):
             result = logscaleClient.execute(query, variable_values=params)
             logging.debug(result)
 
-        except TransportQueryError:
-            logging.exception("TransportQueryError")
+        except LogScaleQueryError:
+            logging.exception("LogScaleQueryError")
             return "", 500
 
     return "", 204
 
 
-@app.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Groups/<id>", methods=["DELETE"])
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Groups/<id>", methods=["DELETE"])
 @token_required
+@idempotent
 def groups_delete(context, *args, **kwargs):
 
     params = {"groupId": kwargs["id"]}
@@ -670,14 +1220,139 @@ def groups_delete(context, *args, **kwargs):
         result = logscaleClient.execute(query, variable_values=params)
         logging.debug(result)
 
-    except TransportQueryError:
-        logging.exception("TransportQueryError")
+    except LogScaleQueryError:
+        logging.exception("LogScaleQueryError")
         return "", 500
 
+    g.tenant.cache("groups").forget(kwargs["id"])
+    store.delete(g.tenant.name, GROUP, kwargs["id"])
+    directory_for(g.tenant).remove_group(kwargs["id"])
+
+    return "", 204
+
+
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Changes", methods=["GET"])
+@token_required
+def changes_get(context):
+    """Resources written by the bridge since the ``since`` cursor.
+
+    Lets an IdP or a sync job fetch only what changed instead of re-pushing
+    the whole directory; pass the returned ``cursor`` on the next call.
+    """
+    since = request.args.get("since", 0, type=int)
+    # at least one, or an empty page would still move the cursor to the end
+    count = max(1, min(request.args.get("count", 1000, type=int), 10000))
+
+    # entries older than the retention were pruned, the caller has to resync
+    first = store.first_seq(g.tenant.name)
+    if since and first and since < first - 1:
+        return scim_error(410, f"Cursor {since} has expired, oldest is {first}")
+
+    changes = store.changes_since(g.tenant.name, since, count)
+    cursor = (
+        changes[-1]["seq"] if changes else max(since, store.last_seq(g.tenant.name))
+    )
+    resources = [
+        {
+            "seq": change["seq"],
+            "resourceType": change["kind"],
+            "id": change["logscale_id"],
+            "externalId": change["external_id"],
+            "operation": change["operation"],
+            "changed": change["changed_at"],
+        }
+        for change in changes
+    ]
+
+    response = make_response(
+        jsonify(
+            {
+                "schemas": ["urn:ietf:params:scim:api:messages:2.0:ListResponse"],
+                "totalResults": len(resources),
+                "itemsPerPage": count,
+                "Resources": resources,
+                "cursor": cursor,
+            }
+        ),
+        200,
+    )
+    response.mimetype = "application/scim+json"
+    return response
+
+
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/CallStats", methods=["GET"])
+@token_required
+def call_stats_get(context):
+    """LogScale calls per SCIM request, by route, for this worker process."""
+    return make_response(
+        jsonify(
+            {
+                "pid": os.getpid(),
+                "routes": calls.stats.summary(),
+                "dispatch": dispatcher.summary(),
+            }
+        ),
+        200,
+    )
+
+
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Profile", methods=["GET"])
+@token_required
+@admin_required
+def profile_get(context):
+    """Profiler state; /Profile/stacks and /Profile/stats return the results."""
+    return make_response(jsonify({"pid": os.getpid(), **profiler.status()}), 200)
+
+
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Profile", methods=["POST"])
+@token_required
+@admin_required
+def profile_post(context):
+    """Profile the next requests, with "sample" or "cprofile", optionally of one route.
+
+    {"mode": "sample", "requests": 20, "route": "PATCH /api/ext/scim/v2/Groups/<id>"}
+    """
+    options = request.get_json(silent=True) or {}
+    try:
+        profiler.arm(
+            options.get("mode", "sample"),
+            int(options.get("requests", 1)),
+            route=options.get("route"),
+            interval=options.get("intervalSeconds"),
+        )
+    except (TypeError, ValueError) as e:
+        return scim_error(400, str(e))
+    return make_response(jsonify({"pid": os.getpid(), **profiler.status()}), 202)
+
+
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Profile", methods=["DELETE"])
+@token_required
+@admin_required
+def profile_delete(context):
+    profiler.reset()
     return "", 204
 
 
-@app.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Schemas", methods=["GET"])
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Profile/stacks", methods=["GET"])
+@token_required
+@admin_required
+def profile_stacks(context):
+    """Sampled stacks in the folded format flamegraph.pl and speedscope read."""
+    return Response(profiler.folded_stacks(), 200, mimetype="text/plain")
+
+
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Profile/stats", methods=["GET"])
+@token_required
+@admin_required
+def profile_stats(context):
+    return Response(
+        profiler.report(request.args.get("sort", "cumulative")),
+        200,
+        mimetype="text/plain",
+    )
+
+
+@scim.route(f"{LOGSCALE_SCIM_PATH_PREFIX}/Schemas", methods=["GET"])
 @token_required
 def get_schema(context):
     return make_response(
@@ -841,5 +1516,120 @@ def get_schema(context):
     )
 
 
+def configure_logging():
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+
+    handler = TimedStreamHandler(sys.stdout)
+    handler.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+
+_worker_pid = None
+
+
+def init_worker(app, workers: int = 1):
+    """Per process setup, run from gunicorn's post_worker_init or the first request."""
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    _worker_pid = os.getpid()
+
+    # before any request, so invalidations published by the other
+    # workers are heard even if this one never publishes any
+    start_invalidation(workers)
+
+    # open the default tenant's session here so gql is loaded before the
+    # first SCIM request rather than during it
+    if DEFAULT_TENANT in tenants:
+        tenants.get(DEFAULT_TENANT).connect()
+
+    # threads do not survive the fork, so they are started per worker
+    start_verifier(tenants)
+    start_warmer(tenants)
+
+
+def create_app():
+    configure_logging()
+
+    app = Flask(__name__)
+    app.json = TimedJSONProvider(app)
+    app.config["MAX_CONTENT_LENGTH"] = LOGSCALE_SCIM_MAX_CONTENT_LENGTH
+    app.register_blueprint(scim)
+    app.wsgi_app = TenantPathMiddleware(
+        app.wsgi_app, LOGSCALE_SCIM_PATH_PREFIX, tenants
+    )
+
+    if LOGSCALE_SCIM_OTEL:
+        from opentelemetry.instrumentation.flask import FlaskInstrumentor
+
+        # probes would otherwise produce a trace every few seconds
+        FlaskInstrumentor().instrument_app(app, excluded_urls="healthz,readyz")
+        calls.enable_tracing()
+        dispatcher.enable_metrics()
+
+    @app.before_request
+    def ensure_worker():
+        if _worker_pid != os.getpid():
+            init_worker(app)
+
+    @app.before_request
+    def begin_calls():
+        rule = request.url_rule.rule if request.url_rule else "unmatched"
+        calls.begin(
+            f"{request.method} {rule}",
+            priority=classify(request.method, request.headers.get("X-SCIM-Priority")),
+        )
+
+    @app.before_request
+    def begin_profile():
+        if request.headers.get("X-SCIM-Debug-Timing"):
+            calls.timings.set(calls.Timings())
+        # a single attribute check is all an unarmed profiler costs
+        if profiler.armed and request.url_rule is not None:
+            if not request.url_rule.rule.startswith(
+                f"{LOGSCALE_SCIM_PATH_PREFIX}/Profile"
+            ):
+                g.profile = profiler.start(request.method, request.url_rule.rule)
+
+    @app.after_request
+    def report_calls(response):
+        context = calls.current.get()
+        if context is not None:
+            response.headers["X-LogScale-Calls"] = str(context.calls)
+        timings = calls.timings.get()
+        token = g.get("scim_token")
+        if timings is not None and token is not None and token.attributes.get("admin"):
+            response.headers["Server-Timing"] = timings.header()
+        return response
+
+    @app.teardown_request
+    def end_calls(exception):
+        calls.end()
+        calls.timings.set(None)
+        capture = g.pop("profile", None)
+        if capture is not None:
+            profiler.finish(capture)
+
+    return app
+
+
+_app = None
+
+
+def __getattr__(name):
+    # keeps "logscalescim.app:app" working without building the app on import
+    global _app
+    if name in ("app", "application"):
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(name)
+
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
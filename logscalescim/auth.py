@@ -0,0 +1,184 @@
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+SCIM_TOKEN = os.environ.get("SCIM_TOKEN", "")
+# comma separated name=token pairs, e.g. "okta=abc,entra=def"
+SCIM_TOKENS = os.environ.get("SCIM_TOKENS", "")
+SCIM_TOKENS_FILE = os.environ.get("SCIM_TOKENS_FILE", "")
+SCIM_TOKENS_RELOAD_SECONDS = float(os.environ.get("SCIM_TOKENS_RELOAD_SECONDS", "5"))
+# default per-token limit in requests/second, 0 disables rate limiting
+SCIM_TOKEN_RATE_LIMIT = float(os.environ.get("SCIM_TOKEN_RATE_LIMIT", "0"))
+SCIM_TOKEN_RATE_BURST = float(os.environ.get("SCIM_TOKEN_RATE_BURST", "0"))
+
+
+def token_digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, rate, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        """Consume one token, returning 0 on success or the seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+
+class ScimToken:
+    __slots__ = ("name", "digest", "bucket", "attributes")
+
+    def __init__(
+        self, name: str, digest: bytes, rate: float = 0, burst: float = 0, **attributes
+    ):
+        self.name = name
+        self.digest = digest
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.attributes = attributes
+
+    def throttle(self) -> float:
+        if self.bucket is None:
+            return 0.0
+        return self.bucket.take()
+
+    def __repr__(self):
+        return f"ScimToken({self.name!r})"
+
+
+def _parse_token_entry(name: str, entry) -> ScimToken:
+    if isinstance(entry, str):
+        entry = {"token": entry}
+    if "sha256" in entry:
+        digest = bytes.fromhex(entry["sha256"])
+    else:
+        digest = token_digest(entry["token"])
+    attributes = {
+        key: value
+        for key, value in entry.items()
+        if key not in ("token", "sha256", "rateLimit", "burst")
+    }
+    return ScimToken(
+        name,
+        digest,
+        rate=float(entry.get("rateLimit", SCIM_TOKEN_RATE_LIMIT)),
+        burst=float(entry.get("burst", SCIM_TOKEN_RATE_BURST)),
+        **attributes,
+    )
+
+
+class TokenRegistry:
+    """Named SCIM bearer tokens, indexed by the SHA-256 digest of the secret.
+
+    Tokens come from SCIM_TOKEN (named "default"), SCIM_TOKENS and the JSON
+    file named by SCIM_TOKENS_FILE::
+
+        {"tokens": {"okta": {"token": "...", "rateLimit": 10, "burst": 20},
+                    "entra": {"sha256": "<hex digest>"}}}
+
+    The file is re-read when its mtime changes so tokens can be rotated
+    without restarting workers. Tokens are first loaded by the first
+    ``authenticate``, not at import, so that is logged through the handlers
+    of the configured logging.
+    """
+
+    def __init__(self, path: str = SCIM_TOKENS_FILE):
+        self.path = path
+        self.by_digest = {}
+        self.loaded = False
+        self.file_mtime = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def reload(self):
+        tokens = {}
+        if SCIM_TOKEN:
+            entry = _parse_token_entry("default", SCIM_TOKEN)
+            tokens[entry.digest] = entry
+        for pair in SCIM_TOKENS.split(","):
+            if "=" not in pair:
+                continue
+            name, token = pair.split("=", 1)
+            entry = _parse_token_entry(name.strip(), token.strip())
+            tokens[entry.digest] = entry
+
+        if self.path:
+            try:
+                self.file_mtime = os.stat(self.path).st_mtime
+                with open(self.path) as f:
+                    config = json.load(f)
+                for name, value in config.get("tokens", {}).items():
+                    entry = _parse_token_entry(name, value)
+                    tokens[entry.digest] = entry
+            except FileNotFoundError:
+                logging.warning(f"SCIM tokens file {self.path} not found")
+                self.file_mtime = None
+            except (ValueError, KeyError, TypeError):
+                logging.exception(f"Unable to load SCIM tokens file {self.path}")
+                if self.by_digest:
+                    # keep serving with the previous generation of tokens
+                    return
+
+        # carry rate limit state over for tokens that did not change
+        for digest, entry in tokens.items():
+            previous = self.by_digest.get(digest)
+            if (
+                previous is not None
+                and previous.bucket is not None
+                and entry.bucket is not None
+                and previous.bucket.rate == entry.bucket.rate
+            ):
+                entry.bucket = previous.bucket
+
+        self.by_digest = tokens
+        self.loaded = True
+        logging.info(f"Loaded {len(tokens)} SCIM tokens")
+
+    def maybe_reload(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.reload()
+            return
+        if not self.path:
+            return
+        now = time.monotonic()
+        if now - self.checked < SCIM_TOKENS_RELOAD_SECONDS:
+            return
+        with self.lock:
+            if now - self.checked < SCIM_TOKENS_RELOAD_SECONDS:
+                return
+            self.checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime != self.file_mtime:
+                self.reload()
+
+    def authenticate(self, token: str):
+        self.maybe_reload()
+        digest = token_digest(token)
+        entry = self.by_digest.get(digest)
+        if entry is not None and hmac.compare_digest(entry.digest, digest):
+            return entry
+        return None
+
+
+tokens = TokenRegistry()
@@ -0,0 +1,638 @@
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# lru (per worker), mmap (shared by the workers on a host) or memcache
+LOGSCALE_CACHE_BACKEND = os.environ.get("LOGSCALE_CACHE_BACKEND", "lru")
+LOGSCALE_CACHE_SIZE = int(os.environ.get("LOGSCALE_CACHE_SIZE", "10000"))
+LOGSCALE_CACHE_TTL = float(os.environ.get("LOGSCALE_CACHE_TTL", "300"))
+LOGSCALE_CACHE_MMAP_PATH = os.environ.get(
+    "LOGSCALE_CACHE_MMAP_PATH",
+    os.path.join(
+        "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+        "logscalescim.cache",
+    ),
+)
+LOGSCALE_CACHE_MMAP_SLOT_SIZE = int(
+    os.environ.get("LOGSCALE_CACHE_MMAP_SLOT_SIZE", "512")
+)
+# number of slots in the separate files of caches that ask for larger slots
+LOGSCALE_CACHE_MMAP_LARGE_SLOTS = int(
+    os.environ.get("LOGSCALE_CACHE_MMAP_LARGE_SLOTS", "512")
+)
+LOGSCALE_CACHE_MEMCACHE_SERVERS = os.environ.get(
+    "LOGSCALE_CACHE_MEMCACHE_SERVERS", "127.0.0.1:11211"
+)
+# e.g. udp://239.255.42.99:30999 to fan deletes out to every worker and replica
+LOGSCALE_CACHE_INVALIDATION = os.environ.get("LOGSCALE_CACHE_INVALIDATION", "")
+# used instead when several workers each keep their own caches
+DEFAULT_INVALIDATION = "udp://239.255.42.99:30999"
+
+
+def _encode(value) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def _decode(data: bytes):
+    return json.loads(data)
+
+
+class LRUCache:
+    def __init__(
+        self, maxsize: int = LOGSCALE_CACHE_SIZE, ttl: float = LOGSCALE_CACHE_TTL
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def _store(self, key, value, ttl: float):
+        self.data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def set(self, key, value, ttl: float = None):
+        with self.lock:
+            self._store(key, value, ttl)
+
+    def add(self, key, value, ttl: float = None) -> bool:
+        """Set key only if it holds no live value, returns whether it did."""
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None and item[0] >= time.monotonic():
+                return False
+            self._store(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self, prefix: str = ""):
+        with self.lock:
+            for key in [key for key in self.data if key.startswith(prefix)]:
+                del self.data[key]
+
+
+class MmapCache:
+    """Fixed-size open addressing hash table in a shared memory mapped file.
+
+    Every gunicorn worker on the host maps the same file, so an entry written
+    or deleted by one worker is immediately seen by the others. Slots are
+    ``slot_size`` bytes; entries that do not fit are not cached, and setting
+    one drops whatever the key held before so no stale value is left behind.
+    Adding one raises ValueError, as nothing could be claimed.
+    """
+
+    HEADER = struct.Struct("<QdHH")
+    PROBES = 8
+
+    def __init__(
+        self,
+        path: str = LOGSCALE_CACHE_MMAP_PATH,
+        slots: int = LOGSCALE_CACHE_SIZE,
+        slot_size: int = LOGSCALE_CACHE_MMAP_SLOT_SIZE,
+        ttl: float = LOGSCALE_CACHE_TTL,
+    ):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * slot_size
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size, mmap.MAP_SHARED)
+        # lockf excludes other processes, the thread lock other threads
+        self.thread_lock = threading.Lock()
+
+    def _hash(self, key: str) -> int:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    @contextmanager
+    def _locked(self):
+        with self.thread_lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def _find(self, key_hash: int, key: bytes):
+        """Return (slot offset holding key or None, first reusable offset)."""
+        free = None
+        now = time.time()
+        start = key_hash % self.slots
+        for probe in range(self.PROBES):
+            offset = ((start + probe) % self.slots) * self.slot_size
+            slot_hash, expires, key_len, _ = self.HEADER.unpack_from(self.map, offset)
+            if slot_hash == key_hash:
+                begin = offset + self.HEADER.size
+                if self.map[begin : begin + key_len] == key:
+                    return offset, free
+            if free is None and (slot_hash == 0 or expires < now):
+                free = offset
+        return None, free
+
+    def get(self, key):
+        key_bytes = key.encode("utf-8")
+        key_hash = self._hash(key)
+        with self._locked():
+            offset, _ = self._find(key_hash, key_bytes)
+            if offset is None:
+                return None
+            _, expires, key_len, value_len = self.HEADER.unpack_from(self.map, offset)
+            if expires < time.time():
+                return None
+            begin = offset + self.HEADER.size + key_len
+            data = self.map[begin : begin + value_len]
+        return _decode(data)
+
+    def _write(self, key, value, ttl: float, only_new: bool) -> bool:
+        key_bytes = key.encode("utf-8")
+        data = _encode(value)
+        if self.HEADER.size + len(key_bytes) + len(data) > self.slot_size:
+            if only_new:
+                raise ValueError(
+                    f"{len(key_bytes) + len(data)} byte entry does not fit in a "
+                    f"{self.slot_size} byte slot"
+                )
+            self.delete(key)
+            return False
+        key_hash = self._hash(key)
+        with self._locked():
+            offset, free = self._find(key_hash, key_bytes)
+            if offset is not None and only_new:
+                _, expires, _, _ = self.HEADER.unpack_from(self.map, offset)
+                if expires >= time.time():
+                    return False
+            if offset is None:
+                # evict the home slot when the whole probe window is busy
+                offset = free
+                if offset is None:
+                    offset = (key_hash % self.slots) * self.slot_size
+            self.HEADER.pack_into(
+                self.map,
+                offset,
+                key_hash,
+                time.time() + (ttl or self.ttl),
+                len(key_bytes),
+                len(data),
+            )
+            begin = offset + self.HEADER.size
+            self.map[begin : begin + len(key_bytes) + len(data)] = key_bytes + data
+        return True
+
+    def set(self, key, value, ttl: float = None):
+        self._write(key, value, ttl, only_new=False)
+
+    def add(self, key, value, ttl: float = None) -> bool:
+        """Set key only if it holds no live value, returns whether it did."""
+        return self._write(key, value, ttl, only_new=True)
+
+    def delete(self, key):
+        key_hash = self._hash(key)
+        with self._locked():
+            offset, _ = self._find(key_hash, key.encode("utf-8"))
+            if offset is not None:
+                self.HEADER.pack_into(self.map, offset, 0, 0, 0, 0)
+
+    def clear(self, prefix: str = ""):
+        prefix_bytes = prefix.encode("utf-8")
+        with self._locked():
+            for slot in range(self.slots):
+                offset = slot * self.slot_size
+                slot_hash, _, key_len, _ = self.HEADER.unpack_from(self.map, offset)
+                begin = offset + self.HEADER.size
+                if slot_hash and self.map[begin : begin + key_len].startswith(
+                    prefix_bytes
+                ):
+                    self.HEADER.pack_into(self.map, offset, 0, 0, 0, 0)
+
+
+class MemcacheCache:
+    """Minimal client for the memcached text protocol.
+
+    Connection errors are logged and treated as cache misses so an
+    unavailable cache never fails a SCIM request.
+    """
+
+    def __init__(
+        self,
+        servers: str = LOGSCALE_CACHE_MEMCACHE_SERVERS,
+        ttl: float = LOGSCALE_CACHE_TTL,
+        timeout: float = 0.5,
+    ):
+        self.servers = []
+        for server in servers.split(","):
+            host, _, port = server.strip().rpartition(":")
+            self.servers.append((host, int(port)))
+        self.ttl = ttl
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _key(self, key: str) -> bytes:
+        encoded = key.encode("utf-8")
+        if len(encoded) > 200 or any(c <= 32 or c == 127 for c in encoded):
+            encoded = hashlib.blake2b(encoded, digest_size=20).hexdigest().encode()
+        return encoded
+
+    def _connection(self, key: bytes):
+        server = self.servers[
+            int.from_bytes(hashlib.blake2b(key, digest_size=4).digest(), "little")
+            % len(self.servers)
+        ]
+        connections = getattr(self.local, "connections", None)
+        if connections is None or self.local.pid != os.getpid():
+            connections = self.local.connections = {}
+            self.local.pid = os.getpid()
+        connection = connections.get(server)
+        if connection is None:
+            sock = socket.create_connection(server, timeout=self.timeout)
+            connection = connections[server] = (sock, sock.makefile("rb"))
+        return server, connection
+
+    def _call(self, key: bytes, command: bytes, reader):
+        try:
+            server, (sock, stream) = self._connection(key)
+        except OSError:
+            logging.warning("memcache server unavailable")
+            return None
+        try:
+            sock.sendall(command)
+            return reader(stream)
+        except OSError:
+            logging.warning("memcache request failed")
+            self.local.connections.pop(server, None)
+            sock.close()
+            return None
+
+    def get(self, key):
+        key = self._key(key)
+
+        def read(stream):
+            line = stream.readline()
+            if not line.startswith(b"VALUE"):
+                return None
+            length = int(line.split()[3])
+            data = stream.read(length + 2)[:-2]
+            stream.readline()  # END
+            return _decode(data)
+
+        return self._call(key, b"get " + key + b"\r\n", read)
+
+    def set(self, key, value, ttl: float = None):
+        key = self._key(key)
+        data = _encode(value)
+        command = b"set %s 0 %d %d\r\n%s\r\n" % (
+            key,
+            int(ttl or self.ttl),
+            len(data),
+            data,
+        )
+        self._call(key, command, lambda stream: stream.readline())
+
+    def add(self, key, value, ttl: float = None) -> bool:
+        """Set key only if it holds no value, returns whether it did.
+
+        An unreachable server counts as a successful add, like a miss.
+        """
+        key = self._key(key)
+        data = _encode(value)
+        command = b"add %s 0 %d %d\r\n%s\r\n" % (
+            key,
+            int(ttl or self.ttl),
+            len(data),
+            data,
+        )
+        reply = self._call(key, command, lambda stream: stream.readline())
+        return reply is None or reply.startswith(b"STORED")
+
+    def delete(self, key):
+        key = self._key(key)
+        self._call(key, b"delete " + key + b"\r\n", lambda stream: stream.readline())
+
+    def clear(self, prefix: str = ""):
+        # memcached cannot enumerate keys, so a namespace is left to expire;
+        # flushing for it would empty the cache of every replica
+        if prefix:
+            return
+        for host, port in self.servers:
+            key = f"{host}:{port}".encode()
+            self._call(key, b"flush_all\r\n", lambda stream: stream.readline())
+
+
+class MemcacheStandIn(socketserver.ThreadingTCPServer):
+    """In-process server for the subset of the memcached protocol used above.
+
+    Meant for tests and local development::
+
+        server = MemcacheStandIn(("127.0.0.1", 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        self.store = {}
+        self.lock = threading.Lock()
+        super().__init__(address, _MemcacheStandInHandler)
+
+
+class _MemcacheStandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        store, lock = self.server.store, self.server.lock
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0]
+            if command == b"get":
+                with lock:
+                    item = store.get(parts[1])
+                if item is not None and (item[0] == 0 or item[0] > time.time()):
+                    self.wfile.write(
+                        b"VALUE %s 0 %d\r\n%s\r\n" % (parts[1], len(item[1]), item[1])
+                    )
+                self.wfile.write(b"END\r\n")
+            elif command in (b"set", b"add"):
+                data = self.rfile.read(int(parts[4]) + 2)[:-2]
+                ttl = int(parts[3])
+                with lock:
+                    item = store.get(parts[1])
+                    if (
+                        command == b"add"
+                        and item is not None
+                        and (item[0] == 0 or item[0] > time.time())
+                    ):
+                        self.wfile.write(b"NOT_STORED\r\n")
+                        continue
+                    store[parts[1]] = (time.time() + ttl if ttl else 0, data)
+                self.wfile.write(b"STORED\r\n")
+            elif command == b"delete":
+                with lock:
+                    found = store.pop(parts[1], None)
+                self.wfile.write(b"DELETED\r\n" if found else b"NOT_FOUND\r\n")
+            elif command == b"flush_all":
+                with lock:
+                    store.clear()
+                self.wfile.write(b"OK\r\n")
+            else:
+                self.wfile.write(b"ERROR\r\n")
+
+
+class InvalidationChannel:
+    """In-process pub/sub for cache invalidations."""
+
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def start(self):
+        pass
+
+    def publish(self, action: str, key: str):
+        self.deliver(action, key)
+
+    def deliver(self, action: str, key: str):
+        for callback in self.subscribers:
+            try:
+                callback(action, key)
+            except Exception:
+                logging.exception("cache invalidation subscriber failed")
+
+
+class UdpInvalidationChannel(InvalidationChannel):
+    """Broadcast invalidations to every worker and replica over UDP multicast.
+
+    Each process needs its own listener thread, so start() is called once
+    the worker forked; publish() starts it too, for processes that skipped
+    that. When the group cannot be joined the channel logs an error and
+    only invalidates this process.
+    """
+
+    def __init__(self, group: str, port: int):
+        super().__init__()
+        self.group = group
+        self.port = port
+        self.sender = uuid.uuid4().hex.encode()
+        self.pid = None
+        self.lock = threading.Lock()
+        self.out = None
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.sender = uuid.uuid4().hex.encode()
+            self.out = None
+            sock = None
+            try:
+                sock = socket.socket(
+                    socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP
+                )
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if hasattr(socket, "SO_REUSEPORT"):
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                sock.bind(("", self.port))
+                membership = socket.inet_aton(self.group) + socket.inet_aton("0.0.0.0")
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+                out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                out.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                out.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            except OSError:
+                if sock is not None:
+                    sock.close()
+                logging.exception(
+                    f"unable to join {self.group}:{self.port}, cache "
+                    "invalidations stay within this process"
+                )
+                return
+            threading.Thread(
+                target=self._listen,
+                args=(sock,),
+                name="cache-invalidation",
+                daemon=True,
+            ).start()
+            self.out = out
+
+    def _listen(self, sock):
+        while True:
+            data = sock.recv(65535)
+            sender, _, message = data.partition(b"\t")
+            if sender == self.sender:
+                continue
+            action, _, key = message.decode("utf-8").partition("\t")
+            self.deliver(action, key)
+
+    def publish(self, action: str, key: str):
+        self.start()
+        self.deliver(action, key)
+        if self.out is None:
+            return
+        message = b"\t".join((self.sender, action.encode(), key.encode("utf-8")))
+        try:
+            self.out.sendto(message, (self.group, self.port))
+        except OSError:
+            logging.exception("unable to publish cache invalidation")
+
+
+class Cache:
+    """A namespace in a cache backend whose deletes are published to a channel."""
+
+    def __init__(self, namespace: str, backend, channel: InvalidationChannel):
+        self.prefix = f"{namespace}:"
+        self.backend = backend
+        self.channel = channel
+
+    def get(self, key):
+        return self.backend.get(self.prefix + key)
+
+    def set(self, key, value, ttl: float = None):
+        self.backend.set(self.prefix + key, value, ttl)
+
+    def add(self, key, value, ttl: float = None) -> bool:
+        return self.backend.add(self.prefix + key, value, ttl)
+
+    def delete(self, key):
+        self.channel.publish("del", self.prefix + key)
+
+    def clear(self):
+        """Drop the namespace, except with memcache where its entries expire."""
+        self.channel.publish("clr", self.prefix)
+
+    def remember(self, key, id):
+        """Cache key -> LogScale id along with the reverse entry used by forget."""
+        self.set(key, id)
+        self.set(f"id:{id}", key)
+
+    def forget(self, id):
+        key = self.get(f"id:{id}")
+        if key is not None:
+            self.delete(key)
+        self.delete(f"id:{id}")
+
+
+_backends = {}
+_channel = None
+
+
+def _invalidation_channel(url: str = None) -> InvalidationChannel:
+    global _channel
+    if _channel is None:
+        url = url or LOGSCALE_CACHE_INVALIDATION
+        if url.startswith("udp://"):
+            group, _, port = url[6:].rpartition(":")
+            _channel = UdpInvalidationChannel(group, int(port))
+        else:
+            _channel = InvalidationChannel()
+
+        def invalidate(action, key):
+            for backend in _backends.values():
+                if action == "del":
+                    backend.delete(key)
+                elif action == "clr":
+                    backend.clear(key)
+
+        _channel.subscribe(invalidate)
+    return _channel
+
+
+def subscribe(callback):
+    """Call ``callback(action, key)`` for every delete ("del") or namespace
+    clear ("clr") published by this or, with multicast, another process."""
+    _invalidation_channel().subscribe(callback)
+
+
+def start_invalidation(workers: int = 1):
+    """Listen for the invalidations of other processes, once per worker.
+
+    Per worker state, lru caches and the directory's group members, only
+    agrees between workers when deletes reach all of them, so with more
+    than one worker and no LOGSCALE_CACHE_INVALIDATION the
+    DEFAULT_INVALIDATION group is used.
+    """
+    url = None
+    if workers > 1:
+        if not LOGSCALE_CACHE_INVALIDATION:
+            url = DEFAULT_INVALIDATION
+        if type(_channel) is InvalidationChannel:
+            logging.warning(
+                f"{workers} workers share no cache invalidation channel, "
+                "their caches and directories can serve stale entries"
+            )
+    _invalidation_channel(url).start()
+
+
+def drop_cache(namespace: str):
+    """Free the lru backend of a namespace that is no longer used.
+
+    The shared mmap and memcache backends are left alone.
+    """
+    if LOGSCALE_CACHE_BACKEND == "lru":
+        _backends.pop(namespace, None)
+
+
+def make_cache(namespace: str, slot_size: int = None) -> Cache:
+    """The cache for ``namespace`` in the configured backend.
+
+    ``slot_size`` is the largest entry the namespace needs to keep. With the
+    mmap backend, a larger one than LOGSCALE_CACHE_MMAP_SLOT_SIZE gets a file
+    of its own with LOGSCALE_CACHE_MMAP_LARGE_SLOTS slots of that size. The
+    other backends keep entries of any size, up to memcached's item size.
+    """
+    channel = _invalidation_channel()
+    if LOGSCALE_CACHE_BACKEND == "mmap":
+        if slot_size is None or slot_size <= LOGSCALE_CACHE_MMAP_SLOT_SIZE:
+            name, path = "mmap", LOGSCALE_CACHE_MMAP_PATH
+            slots, slot_size = LOGSCALE_CACHE_SIZE, LOGSCALE_CACHE_MMAP_SLOT_SIZE
+        else:
+            name, path = f"mmap:{slot_size}", f"{LOGSCALE_CACHE_MMAP_PATH}.{slot_size}"
+            slots = LOGSCALE_CACHE_MMAP_LARGE_SLOTS
+        backend = _backends.get(name)
+        if backend is None:
+            backend = _backends[name] = MmapCache(path, slots, slot_size)
+    elif LOGSCALE_CACHE_BACKEND == "memcache":
+        backend = _backends.get("memcache")
+        if backend is None:
+            backend = _backends["memcache"] = MemcacheCache()
+    elif LOGSCALE_CACHE_BACKEND == "lru":
+        backend = _backends.get(namespace)
+        if backend is None:
+            backend = _backends[namespace] = LRUCache()
+    else:
+        raise ValueError(f"Unknown LOGSCALE_CACHE_BACKEND {LOGSCALE_CACHE_BACKEND}")
+    return Cache(namespace, backend, channel)
@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+# most LogScale calls a single SCIM request may make, 0 for no limit
+LOGSCALE_CALL_BUDGET = int(os.environ.get("LOGSCALE_CALL_BUDGET", "500"))
+
+
+class CallBudgetExceeded(Exception):
+    def __init__(self, context):
+        super().__init__(
+            f"{context.route} exceeded its budget of {context.budget} LogScale calls"
+        )
+        self.context = context
+
+
+class CallContext:
+    """The LogScale calls made on behalf of one SCIM request.
+
+    Shared with the chunk executor's threads, which run under a copy of
+    the request's contextvars. ``priority`` is the request's dispatch class.
+    """
+
+    def __init__(
+        self, route: str, budget: int = LOGSCALE_CALL_BUDGET, priority: int = None
+    ):
+        self.route = route
+        self.budget = budget
+        self.priority = priority
+        self.calls = 0
+        self.seconds = 0.0
+        self.operations = {}
+        self.rejected = False
+        self.lock = threading.Lock()
+
+    def charge(self, operation: str):
+        with self.lock:
+            if self.budget and self.calls >= self.budget:
+                self.rejected = True
+                raise CallBudgetExceeded(self)
+            self.calls += 1
+            self.operations[operation] = self.operations.get(operation, 0) + 1
+
+    def add_time(self, seconds: float):
+        with self.lock:
+            self.seconds += seconds
+
+
+class RouteStats:
+    """Calls-per-request summary of every route, for this worker process."""
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def record(self, context: CallContext):
+        with self.lock:
+            stats = self.routes.get(context.route)
+            if stats is None:
+                stats = self.routes[context.route] = {
+                    "requests": 0,
+                    "calls": 0,
+                    "maxCalls": 0,
+                    "logscaleSeconds": 0.0,
+                    "rejected": 0,
+                    "operations": {},
+                }
+            stats["requests"] += 1
+            stats["calls"] += context.calls
+            stats["maxCalls"] = max(stats["maxCalls"], context.calls)
+            stats["logscaleSeconds"] += context.seconds
+            stats["rejected"] += context.rejected
+            for operation, count in context.operations.items():
+                stats["operations"][operation] = (
+                    stats["operations"].get(operation, 0) + count
+                )
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                route: {
+                    **stats,
+                    "operations": dict(stats["operations"]),
+                    "meanCalls": stats["calls"] / stats["requests"],
+                }
+                for route, stats in self.routes.items()
+            }
+
+
+class Timings:
+    """Wall time per phase of one request, for the Server-Timing header.
+
+    Phases may overlap, chunk threads wait on LogScale in parallel, so they
+    do not have to add up to the total.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def header(self) -> str:
+        total = time.perf_counter() - self.started
+        with self.lock:
+            phases = dict(self.phases)
+        phases["total"] = total
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.2f}" for name, seconds in phases.items()
+        )
+
+
+current = ContextVar("logscalescim_calls", default=None)
+timings = ContextVar("logscalescim_timings", default=None)
+stats = RouteStats()
+tracer = None
+_untimed = nullcontext()
+
+
+@contextmanager
+def _timed(recorder: Timings, name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add(name, time.perf_counter() - started)
+
+
+def phase(name: str):
+    """Time a block as ``name`` when the request asked for phase timings."""
+    recorder = timings.get()
+    if recorder is None:
+        return _untimed
+    return _timed(recorder, name)
+
+
+def enable_tracing():
+    """Emit an OpenTelemetry span for every LogScale call."""
+    global tracer
+    from opentelemetry import trace
+
+    tracer = trace.get_tracer("logscalescim")
+
+
+def begin(
+    route: str, budget: int = LOGSCALE_CALL_BUDGET, priority: int = None
+) -> CallContext:
+    context = CallContext(route, budget, priority)
+    current.set(context)
+    return context
+
+
+def end():
+    context = current.get()
+    if context is not None:
+        current.set(None)
+        stats.record(context)
+    return context
+
+
+def operation_name(document) -> str:
+    try:
+        return document.definitions[0].name.value
+    except (AttributeError, IndexError):
+        return "anonymous"
+
+
+@contextmanager
+def tracked(tenant: str, document):
+    """Charge, time and trace one LogScale call against the current request."""
+    operation = operation_name(document)
+    context = current.get()
+    if context is not None:
+        context.charge(operation)
+
+    if tracer is None:
+        span = nullcontext()
+    else:
+        span = tracer.start_as_current_span(
+            f"logscale {operation}",
+            attributes={
+                "graphql.operation.name": operation,
+                "logscalescim.tenant": tenant,
+            },
+        )
+    started = time.perf_counter()
+    try:
+        with span, phase("upstream"):
+            yield
+    finally:
+        if context is not None:
+            context.add_time(time.perf_counter() - started)
@@ -0,0 +1,139 @@
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from itertools import islice
+
+from logscalescim.calls import CallBudgetExceeded
+from logscalescim.tenants import LogScaleQueryError, document
+
+LOGSCALE_MEMBER_CHUNK_SIZE = int(os.environ.get("LOGSCALE_MEMBER_CHUNK_SIZE", "1000"))
+LOGSCALE_MEMBER_CHUNK_PARALLELISM = int(
+    os.environ.get("LOGSCALE_MEMBER_CHUNK_PARALLELISM", "4")
+)
+# how many times a rejected chunk is halved while looking for the bad members,
+# 0 halves it until single members are reached
+LOGSCALE_MEMBER_BISECT_DEPTH = int(os.environ.get("LOGSCALE_MEMBER_BISECT_DEPTH", "0"))
+
+
+def chunks(iterable, size: int = LOGSCALE_MEMBER_CHUNK_SIZE):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ChunkResult:
+    """Outcome of a chunked membership change.
+
+    ``failed`` maps each member that could not be applied to its error.
+    There is nothing to resume here: the IdP retries the request, and
+    replace_members then re-reads the group and only sends what is missing.
+    """
+
+    def __init__(self):
+        self.applied = 0
+        self.chunks = 0
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    def record_applied(self, users: list):
+        with self.lock:
+            self.applied += len(users)
+
+    def record_failed(self, users: list, error: str):
+        with self.lock:
+            for user in users:
+                self.failed[user] = error
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+    def summary(self, limit: int = 20) -> str:
+        members = ", ".join(sorted(self.failed)[:limit])
+        more = len(self.failed) - limit
+        if more > 0:
+            members += f" and {more} more"
+        return f"{len(self.failed)} members failed: {members}"
+
+
+class MembershipError(Exception):
+    def __init__(self, result: ChunkResult):
+        super().__init__(result.summary())
+        self.result = result
+
+
+class ChunkedExecutor:
+    """Apply a membership mutation in chunks with bounded parallelism.
+
+    A chunk rejected by LogScale is bisected down to the offending members,
+    or at most LOGSCALE_MEMBER_BISECT_DEPTH times, so one bad id does not
+    fail the other members of its chunk.
+    Transport failures (timeouts, connection errors) are not bisected; the
+    whole chunk is reported as failed.
+    """
+
+    def __init__(
+        self,
+        tenant,
+        chunk_size: int = LOGSCALE_MEMBER_CHUNK_SIZE,
+        parallelism: int = LOGSCALE_MEMBER_CHUNK_PARALLELISM,
+    ):
+        self.tenant = tenant
+        self.chunk_size = chunk_size
+        self.parallelism = max(1, parallelism)
+        # ceil(log2(chunk_size)) halvings reach single members
+        self.bisect_depth = (
+            LOGSCALE_MEMBER_BISECT_DEPTH or (max(1, chunk_size) - 1).bit_length()
+        )
+
+    def _apply(
+        self, query, groupId: str, users: list, result: ChunkResult, depth: int = 0
+    ):
+        params = {"input": {"groupId": groupId, "users": users}}
+        try:
+            self.tenant.execute(query, variable_values=params)
+            result.record_applied(users)
+        except LogScaleQueryError as e:
+            if len(users) == 1 or depth >= self.bisect_depth:
+                result.record_failed(users, str(e))
+                return
+            middle = len(users) // 2
+            self._apply(query, groupId, users[:middle], result, depth + 1)
+            self._apply(query, groupId, users[middle:], result, depth + 1)
+        except CallBudgetExceeded as e:
+            result.record_failed(users, str(e))
+        except Exception as e:
+            logging.exception(f"Chunk of {len(users)} members for {groupId} failed")
+            result.record_failed(users, str(e))
+
+    def run(self, groupId: str, mutation: str, users) -> ChunkResult:
+        query = document(mutation)
+        result = ChunkResult()
+        if self.parallelism == 1:
+            for chunk in chunks(users, self.chunk_size):
+                result.chunks += 1
+                self._apply(query, groupId, chunk, result)
+            return result
+
+        # only keep a window of chunks in flight so streamed inputs are not
+        # materialized up front
+        with ThreadPoolExecutor(max_workers=self.parallelism) as pool:
+            running = set()
+            for chunk in chunks(users, self.chunk_size):
+                result.chunks += 1
+                # each chunk runs under the request's contextvars so its calls
+                # are charged and traced as part of that request
+                running.add(
+                    pool.submit(
+                        copy_context().run, self._apply, query, groupId, chunk, result
+                    )
+                )
+                if len(running) >= self.parallelism * 2:
+                    _, running = wait(running, return_when=FIRST_COMPLETED)
+            wait(running)
+        return result
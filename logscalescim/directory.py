@@ -0,0 +1,424 @@
+import logging
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from sys import intern
+
+from logscalescim.cache import subscribe
+from logscalescim.tenants import document
+
+LOGSCALE_DIRECTORY_PAGE_SIZE = int(
+    os.environ.get("LOGSCALE_DIRECTORY_PAGE_SIZE", "500")
+)
+
+LOGSCALE_GQL_QUERY_USERS_PAGE = """query UsersPage($pageNumber: Int!, $pageSize: Int!) {
+  usersPage(pageNumber: $pageNumber, pageSize: $pageSize) {
+    pageInfo {
+      nextNumber
+    }
+    page {
+      id
+      username
+      email
+      displayName
+    }
+  }
+}"""
+
+LOGSCALE_GQL_QUERY_GROUPS_PAGE = """query GroupsPage($pageNumber: Int!, $pageSize: Int!) {
+  groupsPage(pageNumber: $pageNumber, pageSize: $pageSize) {
+    pageInfo {
+      nextNumber
+    }
+    page {
+      id
+      displayName
+      lookupName
+    }
+  }
+}"""
+
+LOGSCALE_GQL_QUERY_ROLES = """query Roles {
+  roles {
+    id
+    displayName
+  }
+}"""
+
+LOGSCALE_GQL_MUTATION_ASSIGN_GROUP_TO_ORGANIZATION_ROLE = """mutation AssignOrganizationRoleToGroup($input: AssignOrganizationRoleToGroupInput!) {
+  assignOrganizationRoleToGroup(input: $input) {
+    group {
+      role {
+        displayName
+      }
+    }
+  }
+}"""
+LOGSCALE_GQL_MUTATION_ASSIGN_GROUP_TO_CLUSTER_ROLE = """mutation AssignSystemRoleToGroup($input: AssignSystemRoleToGroupInput!) {
+  assignSystemRoleToGroup(input: $input) {
+    group {
+      role {
+        id
+      }
+    }
+  }
+}"""
+LOGSCALE_GQL_MUTATION_GROUP_ADD = """mutation AddGroup($displayName: String!, $lookupName: String) {
+  addGroup(displayName: $displayName, lookupName: $lookupName) {
+    group {
+      id
+    }
+  }
+}"""
+LOGSCALE_GQL_MUTATION_USER_ADD = """mutation AddUserV2($input: AddUserInputV2!) {
+  addUserV2(input: $input) {
+    ... on User {
+      id
+    }
+  }
+}"""
+
+
+def iter_pages(tenant, source: str, field: str, page_size: int = None, pace=None):
+    """Yield every node of a LogScale ``*Page`` query, one page in memory at a time.
+
+    ``pace`` is called before each page is requested, to throttle background
+    reads.
+    """
+    query = document(source)
+    pageNumber = 1
+    while pageNumber:
+        if pace is not None:
+            pace()
+        params = {
+            "pageNumber": pageNumber,
+            "pageSize": page_size or LOGSCALE_DIRECTORY_PAGE_SIZE,
+        }
+        result = tenant.execute(query, variable_values=params)[field]
+        yield from result["page"]
+        pageNumber = result["pageInfo"]["nextNumber"]
+
+
+def iter_users(tenant, page_size: int = None, pace=None):
+    return iter_pages(
+        tenant, LOGSCALE_GQL_QUERY_USERS_PAGE, "usersPage", page_size, pace
+    )
+
+
+def iter_groups(tenant, page_size: int = None, pace=None):
+    return iter_pages(
+        tenant, LOGSCALE_GQL_QUERY_GROUPS_PAGE, "groupsPage", page_size, pace
+    )
+
+
+def iter_roles(tenant, pace=None):
+    if pace is not None:
+        pace()
+    return iter(tenant.execute(document(LOGSCALE_GQL_QUERY_ROLES))["roles"])
+
+
+# joins the fields of a user row, LogScale does not allow it in any of them
+SEPARATOR = "\x1f"
+ID, USERNAME, EMAIL, DISPLAY_NAME = range(4)
+
+
+class HashIndex:
+    """Maps strings to user surrogates without keeping the strings.
+
+    Entries are (hash, surrogate) pairs in two parallel sorted arrays, with
+    recent additions in a small dict until the next merge. A hash match is
+    confirmed against the stored row, so removed or changed rows and hash
+    collisions are never returned. The arrays and the dict are replaced
+    together as one tuple, so a lookup without the directory lock never
+    sees them from different merges.
+    """
+
+    __slots__ = ("rows", "field", "state")
+
+    def __init__(self, rows: list, field: int):
+        self.rows = rows
+        self.field = field
+        # (hashes, surrogates, recent)
+        self.state = (array("q"), array("I"), {})
+
+    def key_of(self, surrogate: int):
+        row = self.rows[surrogate]
+        if row is None:
+            return None
+        if self.field == ID:
+            return row[: row.index(SEPARATOR)]
+        return row.split(SEPARATOR, self.field + 1)[self.field]
+
+    def add(self, key: str, surrogate: int):
+        hashes, _, recent = self.state
+        found = recent.get(key, ())
+        if surrogate not in found:
+            recent[key] = found + (surrogate,)
+        # merging geometrically keeps the sorting cost amortized
+        if len(recent) > max(4096, len(hashes) // 4):
+            self.merge()
+
+    def merge(self):
+        hashes, surrogates, recent = self.state
+        pairs = [
+            (hash(key), surrogate)
+            for key, found in recent.items()
+            for surrogate in found
+            if self.key_of(surrogate) == key
+        ]
+        pairs.extend(
+            (hashed, surrogate)
+            for hashed, surrogate in zip(hashes, surrogates)
+            if hash(self.key_of(surrogate)) == hashed
+        )
+        pairs = sorted(set(pairs))
+        self.state = (
+            array("q", (hashed for hashed, _ in pairs)),
+            array("I", (surrogate for _, surrogate in pairs)),
+            {},
+        )
+
+    def get(self, key: str) -> list:
+        hashes, surrogates, recent = self.state
+        found = [
+            surrogate
+            for surrogate in recent.get(key, ())
+            if self.key_of(surrogate) == key
+        ]
+        if not hashes:
+            return found
+        hashed = hash(key)
+        position = bisect_left(hashes, hashed)
+        while position < len(hashes) and hashes[position] == hashed:
+            surrogate = surrogates[position]
+            if surrogate not in found and self.key_of(surrogate) == key:
+                found.append(surrogate)
+            position += 1
+        return found
+
+
+class GroupRecord:
+    __slots__ = ("id", "display_name", "lookup_name", "members", "rows")
+
+    def __init__(self, id: str, display_name: str, lookup_name: str, rows: list):
+        # group names repeat across tenants fed by the same IdP
+        self.id = intern(id)
+        self.display_name = intern(display_name) if display_name else None
+        self.lookup_name = intern(lookup_name) if lookup_name else None
+        # sorted user surrogates, None until the members are known
+        self.members = None
+        # the rows the surrogates point into, a reload replaces both
+        self.rows = rows
+
+
+class Directory:
+    """Compact copy of one tenant's LogScale users and groups.
+
+    A user is one packed string in ``rows`` under an integer surrogate key,
+    looked up by id and email through hash indexes instead of dicts of
+    strings. A group's members are a sorted array of surrogates. See
+    benchmarks/bench_directory.py for the footprint against plain dicts.
+
+    Writers hold the lock, readers do not. A reload swaps in new rows,
+    indexes and groups one after the other, so readers resolve surrogates
+    against the rows of the index or group they got them from, and skip
+    rows of removed users.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.by_id = HashIndex(self.rows, ID)
+        self.by_email = HashIndex(self.rows, EMAIL)
+        self.users = 0
+        self.groups = {}
+        self.loaded = False
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.users
+
+    @staticmethod
+    def _field(rows: list, surrogate: int, field: int):
+        row = rows[surrogate]
+        if row is None:
+            return None
+        return row.split(SEPARATOR, field + 1)[field]
+
+    def _surrogates(self, ids) -> array:
+        return array("I", sorted({self._surrogate(id) for id in ids}))
+
+    def _surrogate(self, id: str, create: bool = True):
+        found = self.by_id.get(id)
+        if found:
+            return found[0]
+        if not create:
+            return None
+        # members can name users the directory has not loaded yet
+        surrogate = len(self.rows)
+        self.rows.append(SEPARATOR.join((id, "", "", "")))
+        self.by_id.add(id, surrogate)
+        self.users += 1
+        return surrogate
+
+    def add_user(self, id: str, username: str, email: str, display_name: str = None):
+        with self.lock:
+            surrogate = self._surrogate(id)
+            self.rows[surrogate] = SEPARATOR.join(
+                (id, username or "", email or "", display_name or "")
+            )
+            if email:
+                self.by_email.add(email, surrogate)
+        return surrogate
+
+    def remove_user(self, id: str):
+        with self.lock:
+            surrogate = self._surrogate(id, create=False)
+            if surrogate is None:
+                return
+            # the surrogate is not reused, the indexes skip the cleared row
+            self.rows[surrogate] = None
+            self.users -= 1
+            for group in self.groups.values():
+                if group.members is not None and self._contains(
+                    group.members, surrogate
+                ):
+                    group.members = array(
+                        "I", (other for other in group.members if other != surrogate)
+                    )
+
+    def user(self, id: str):
+        by_id = self.by_id
+        found = by_id.get(id)
+        row = by_id.rows[found[0]] if found else None
+        if row is None:
+            return None
+        id, username, email, display_name = row.split(SEPARATOR)
+        return {
+            "id": id,
+            "username": username or None,
+            "email": email or None,
+            "displayName": display_name or None,
+        }
+
+    def find_user(self, email: str, username: str = None):
+        """The id of the user with ``email``, preferring one that also has
+        ``username``, like lookup_user_by_email does."""
+        by_email = self.by_email
+        found = by_email.get(email)
+        if not found:
+            return None
+        for surrogate in found:
+            if self._field(by_email.rows, surrogate, USERNAME) == username:
+                return self._field(by_email.rows, surrogate, ID)
+        return self._field(by_email.rows, found[0], ID)
+
+    def add_group(self, id: str, display_name: str, lookup_name: str = None):
+        with self.lock:
+            group = self.groups.get(id)
+            if group is None:
+                group = GroupRecord(id, display_name, lookup_name, self.rows)
+                self.groups[group.id] = group
+            else:
+                group.display_name = intern(display_name) if display_name else None
+                group.lookup_name = intern(lookup_name) if lookup_name else None
+            return group
+
+    def remove_group(self, id: str):
+        with self.lock:
+            self.groups.pop(id, None)
+
+    def group(self, id: str):
+        return self.groups.get(id)
+
+    @staticmethod
+    def _contains(members: array, surrogate: int) -> bool:
+        position = bisect_left(members, surrogate)
+        return position < len(members) and members[position] == surrogate
+
+    def set_members(self, groupId: str, users):
+        with self.lock:
+            group = self.groups.get(groupId)
+            if group is None:
+                group = GroupRecord(groupId, None, None, self.rows)
+                self.groups[group.id] = group
+            group.members = self._surrogates(users)
+
+    def forget_members(self, groupId: str = None):
+        """Drop the known members of a group, or of every group."""
+        if groupId is None:
+            for group in list(self.groups.values()):
+                group.members = None
+            return
+        group = self.groups.get(groupId)
+        if group is not None:
+            group.members = None
+
+    def members(self, groupId: str):
+        """Member ids of a group, or None when they are not known."""
+        group = self.groups.get(groupId)
+        members = group.members if group is not None else None
+        if members is None:
+            return None
+        ids = (self._field(group.rows, surrogate, ID) for surrogate in members)
+        return [id for id in ids if id is not None]
+
+    def load(self, tenant, page_size: int = None, pace=None):
+        """Replace the contents with every user and group of ``tenant``."""
+        fresh = Directory()
+        for user in iter_users(tenant, page_size, pace):
+            fresh.add_user(
+                user["id"], user["username"], user["email"], user["displayName"]
+            )
+        for group in iter_groups(tenant, page_size, pace):
+            fresh.add_group(group["id"], group["displayName"], group["lookupName"])
+        with self.lock:
+            # keep the members already known for groups that still exist
+            for id, group in fresh.groups.items():
+                known = self.groups.get(id)
+                if known is not None and known.members is not None:
+                    group.members = fresh._surrogates(
+                        self._field(known.rows, member, ID)
+                        for member in known.members
+                        if known.rows[member] is not None
+                    )
+            fresh.by_id.merge()
+            fresh.by_email.merge()
+            self.rows = fresh.rows
+            self.by_id = fresh.by_id
+            self.by_email = fresh.by_email
+            self.users = fresh.users
+            self.groups = fresh.groups
+            self.loaded = True
+            self.loaded_at = time.time()
+        logging.info(
+            f"Loaded directory for tenant {tenant.name}: users={len(self)} groups={len(self.groups)}"
+        )
+        return self
+
+
+directories = {}
+
+
+def _invalidate(action: str, key: str):
+    """Follow the deletes of the tenants' "members" caches, which other
+    workers publish when they change a group's members."""
+    for name, directory in list(directories.items()):
+        prefix = f"{name}:members:"
+        if not key.startswith(prefix):
+            continue
+        if action == "del":
+            directory.forget_members(key[len(prefix) :])
+        elif action == "clr":
+            directory.forget_members()
+
+
+def directory_for(tenant) -> Directory:
+    directory = directories.get(tenant.name)
+    if directory is None:
+        if not directories:
+            subscribe(_invalidate)
+        directory = directories.setdefault(tenant.name, Directory())
+    return directory
@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# LogScale calls in flight at once across all tenants of this worker
+LOGSCALE_DISPATCH_CONCURRENCY = int(
+    os.environ.get("LOGSCALE_DISPATCH_CONCURRENCY", "16")
+)
+# queue waits kept per priority class for the percentiles in /CallStats
+LOGSCALE_DISPATCH_SAMPLES = int(os.environ.get("LOGSCALE_DISPATCH_SAMPLES", "2048"))
+
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+PRIORITIES = {"interactive": INTERACTIVE, "normal": NORMAL, "bulk": BULK}
+NAMES = {value: name for name, value in PRIORITIES.items()}
+
+
+def classify(method: str, header: str = None, token_priority: str = None) -> int:
+    """Priority class of a SCIM request.
+
+    A "priority" attribute on the SCIM token wins, then the X-SCIM-Priority
+    header. Otherwise creates and deletes are interactive, since someone is
+    usually waiting on them, PUT and PATCH are the bulk of an IdP re-sync
+    and reads sit in between.
+    """
+    for name in (token_priority, header):
+        if name and name.lower() in PRIORITIES:
+            return PRIORITIES[name.lower()]
+    if method in ("POST", "DELETE"):
+        return INTERACTIVE
+    if method in ("PUT", "PATCH"):
+        return BULK
+    return NORMAL
+
+
+class Waiter:
+    __slots__ = ("tenant", "weight", "granted", "queued_at")
+
+    def __init__(self, tenant: str, weight: float):
+        self.tenant = tenant
+        self.weight = weight
+        self.granted = threading.Event()
+        self.queued_at = time.perf_counter()
+
+
+class Dispatcher:
+    """Hands out LogScale call slots by priority class, then fairly by tenant.
+
+    A waiting call of a higher class always goes first. Within a class
+    tenants are served by weighted fair queuing: every call a tenant starts
+    advances its virtual time by 1/weight and the waiting tenant with the
+    lowest virtual time goes next, so one tenant's bulk push cannot starve
+    another's. A tenant never holds more than its own max_concurrency slots.
+    Threads without a SCIM request, like the warmer and verifier, are bulk.
+    """
+
+    def __init__(self, capacity: int = LOGSCALE_DISPATCH_CONCURRENCY):
+        self.capacity = capacity
+        self.running = 0
+        self.tenants = {}
+        self.queues = [{} for _ in NAMES]
+        self.virtual = {}
+        self.waits = [deque(maxlen=LOGSCALE_DISPATCH_SAMPLES) for _ in NAMES]
+        self.counts = [0 for _ in NAMES]
+        self.histogram = None
+        self.lock = threading.Lock()
+
+    def enable_metrics(self):
+        """Export queue waits as an OpenTelemetry histogram."""
+        from opentelemetry import metrics
+
+        self.histogram = metrics.get_meter("logscalescim").create_histogram(
+            "logscalescim.dispatch.queue_wait",
+            unit="s",
+            description="Time LogScale calls waited for a slot, by priority class",
+        )
+
+    def _start(self, tenant: str, weight: float):
+        self.tenants[tenant][0] += 1
+        self.running += 1
+        virtual = self.virtual.get(tenant)
+        if virtual is None:
+            # a tenant that was idle starts level with the least served of
+            # the others instead of with credit for the time it was away
+            virtual = min(self.virtual.values(), default=0.0)
+        self.virtual[tenant] = virtual + 1 / weight
+
+    def _next(self):
+        for queue in self.queues:
+            best = None
+            for tenant in queue:
+                running, limit = self.tenants[tenant]
+                if running >= limit:
+                    continue
+                if best is None or self.virtual.get(tenant, 0.0) < self.virtual.get(
+                    best, 0.0
+                ):
+                    best = tenant
+            if best is not None:
+                waiters = queue[best]
+                waiter = waiters.popleft()
+                if not waiters:
+                    del queue[best]
+                return waiter
+        return None
+
+    def _dispatch(self):
+        while self.running < self.capacity:
+            waiter = self._next()
+            if waiter is None:
+                return
+            self._start(waiter.tenant, waiter.weight)
+            waiter.granted.set()
+
+    def _record(self, priority: int, waited: float, tenant: str):
+        with self.lock:
+            self.waits[priority].append(waited)
+            self.counts[priority] += 1
+        if self.histogram is not None:
+            self.histogram.record(
+                waited,
+                {
+                    "logscalescim.priority": NAMES[priority],
+                    "logscalescim.tenant": tenant,
+                },
+            )
+
+    def acquire(self, tenant: str, limit: int, priority: int, weight: float = 1.0):
+        waiter = Waiter(tenant, weight)
+        with self.lock:
+            state = self.tenants.setdefault(tenant, [0, limit])
+            state[1] = limit
+            self.queues[priority].setdefault(tenant, deque()).append(waiter)
+            self._dispatch()
+        waiter.granted.wait()
+        self._record(priority, time.perf_counter() - waiter.queued_at, tenant)
+
+    def release(self, tenant: str):
+        with self.lock:
+            state = self.tenants[tenant]
+            state[0] -= 1
+            self.running -= 1
+            if not state[0] and not any(tenant in queue for queue in self.queues):
+                del self.tenants[tenant]
+                self.virtual.pop(tenant, None)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, tenant: str, limit: int, priority: int, weight: float = 1.0):
+        self.acquire(tenant, limit, priority, weight)
+        try:
+            yield
+        finally:
+            self.release(tenant)
+
+    def summary(self) -> dict:
+        with self.lock:
+            classes = {}
+            for priority, name in NAMES.items():
+                waits = sorted(self.waits[priority])
+                classes[name] = {
+                    "calls": self.counts[priority],
+                    "queued": sum(len(w) for w in self.queues[priority].values()),
+                    "waitP50Ms": _percentile(waits, 0.5),
+                    "waitP99Ms": _percentile(waits, 0.99),
+                    "waitMaxMs": round(waits[-1] * 1000, 1) if waits else 0.0,
+                }
+            return {
+                "capacity": self.capacity,
+                "running": self.running,
+                "classes": classes,
+            }
+
+
+def _percentile(ordered: list, fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return round(ordered[index] * 1000, 1)
+
+
+dispatcher = Dispatcher()
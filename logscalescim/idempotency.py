@@ -0,0 +1,180 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+
+# how long a response is replayed for an explicit Idempotency-Key
+LOGSCALE_IDEMPOTENCY_TTL = float(os.environ.get("LOGSCALE_IDEMPOTENCY_TTL", "3600"))
+# how long a retry recognised by its fingerprint, that waited on the
+# original, can still pick up the original's response
+LOGSCALE_IDEMPOTENCY_FINGERPRINT_TTL = float(
+    os.environ.get("LOGSCALE_IDEMPOTENCY_FINGERPRINT_TTL", "60")
+)
+# how long a duplicate waits for the original request to finish
+LOGSCALE_IDEMPOTENCY_WAIT_SECONDS = float(
+    os.environ.get("LOGSCALE_IDEMPOTENCY_WAIT_SECONDS", "30")
+)
+# a claim is renewed while its request runs and expires this long after
+# the worker running it died
+LOGSCALE_IDEMPOTENCY_LEASE_SECONDS = float(
+    os.environ.get("LOGSCALE_IDEMPOTENCY_LEASE_SECONDS", "30")
+)
+# largest stored response with the mmap cache backend, in bytes with its
+# key; a larger one is not replayed and the retries of its request run again
+LOGSCALE_IDEMPOTENCY_SLOT_SIZE = int(
+    os.environ.get("LOGSCALE_IDEMPOTENCY_SLOT_SIZE", str(32 * 1024))
+)
+# larger bodies are streamed, not fingerprinted
+LOGSCALE_IDEMPOTENCY_MAX_BODY = int(
+    os.environ.get("LOGSCALE_IDEMPOTENCY_MAX_BODY", str(1024 * 1024))
+)
+
+PENDING = "pending"
+DONE = "done"
+
+
+class Claim:
+    """A key this process is running the request for."""
+
+    __slots__ = ("cache", "owner", "event", "entry")
+
+    def __init__(self, cache, owner: str):
+        self.cache = cache
+        self.owner = owner
+        self.event = threading.Event()
+        self.entry = None
+
+
+# keys being run by this process
+_inflight = {}
+_inflight_lock = threading.Lock()
+_renewer = None
+
+
+def body_hash(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+def fingerprint(token: str, tenant: str, method: str, path: str, digest: str) -> str:
+    """Identifies a retry of the same write when the IdP sends no key."""
+    source = "\0".join((token, tenant, method, path, digest))
+    return "fp:" + hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def _result_key(key: str, owner: str) -> str:
+    return f"{key}:{owner}"
+
+
+def _renew():
+    """Keep the claims of this process alive while their requests run."""
+    while True:
+        time.sleep(LOGSCALE_IDEMPOTENCY_LEASE_SECONDS / 3)
+        with _inflight_lock:
+            for key, claim in _inflight.items():
+                try:
+                    claim.cache.set(
+                        key,
+                        {"state": PENDING, "owner": claim.owner},
+                        ttl=LOGSCALE_IDEMPOTENCY_LEASE_SECONDS,
+                    )
+                except Exception:
+                    logging.exception("unable to renew idempotency claim")
+
+
+def _start_renewer():
+    global _renewer
+    if _renewer is None or _renewer[0] != os.getpid():
+        thread = threading.Thread(target=_renew, name="idempotency", daemon=True)
+        thread.start()
+        _renewer = (os.getpid(), thread)
+
+
+def acquire(cache, key: str):
+    """Claim ``key`` for the current request.
+
+    Returns None when the caller now owns the key and must call complete()
+    or abandon(). Otherwise returns the entry of the original request: a
+    DONE entry to replay, or a PENDING one when it did not finish within
+    LOGSCALE_IDEMPOTENCY_WAIT_SECONDS. The claim is an atomic add, so only
+    one worker runs the request. Duplicates in this process wait on the
+    original's Event; those in other workers poll the shared cache.
+    """
+    deadline = time.monotonic() + LOGSCALE_IDEMPOTENCY_WAIT_SECONDS
+    owner = None
+    while True:
+        with _inflight_lock:
+            claim = _inflight.get(key)
+            if claim is None:
+                mine = uuid.uuid4().hex
+                if cache.add(
+                    key,
+                    {"state": PENDING, "owner": mine},
+                    ttl=LOGSCALE_IDEMPOTENCY_LEASE_SECONDS,
+                ):
+                    _inflight[key] = Claim(cache, mine)
+                    _start_renewer()
+                    claimed = True
+                else:
+                    claimed = False
+        if claim is None and claimed:
+            # the request we waited on may have just finished
+            result = owner and cache.get(_result_key(key, owner))
+            if not result:
+                return None
+            abandon(cache, key)
+            return result
+        remaining = deadline - time.monotonic()
+        if claim is not None:
+            if remaining <= 0:
+                return {"state": PENDING}
+            if claim.event.wait(remaining) and claim.entry is not None:
+                return claim.entry
+            continue
+        entry = cache.get(key)
+        if entry is None:
+            # released since the add, claim it now
+            continue
+        if entry["state"] == DONE:
+            return entry
+        owner = entry.get("owner")
+        if remaining <= 0:
+            return entry
+        time.sleep(min(0.05, remaining))
+
+
+def _release(key: str):
+    with _inflight_lock:
+        claim = _inflight.pop(key, None)
+    return claim
+
+
+def complete(cache, key: str, entry: dict, ttl: float, keep: bool = True):
+    """Finish a claimed key with the response to hand to duplicates.
+
+    With ``keep`` the response is replayed to every request with the same
+    key for ``ttl`` seconds. Otherwise it only goes to duplicates that were
+    already waiting on this request, and a later identical write runs again.
+    A response the cache cannot hold is only handed to the duplicates in
+    this process; those in other workers run the request again.
+    """
+    entry = {**entry, "state": DONE}
+    claim = _release(key)
+    if keep:
+        cache.set(key, entry, ttl=ttl)
+    else:
+        if claim is not None:
+            cache.set(_result_key(key, claim.owner), entry, ttl=ttl)
+        cache.delete(key)
+    if claim is not None:
+        claim.entry = entry
+        claim.event.set()
+
+
+def abandon(cache, key: str):
+    """Forget a claimed key so a retry runs the request again."""
+    claim = _release(key)
+    cache.delete(key)
+    if claim is not None:
+        claim.event.set()
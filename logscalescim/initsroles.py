@@ -1,7 +1,4 @@
 import time
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from werkzeug.security import generate_password_hash, check_password_hash
-from functools import wraps
 
 import sys
 import os
@@ -10,6 +7,12 @@ from gql import Client, gql
 from gql.transport.exceptions import TransportQueryError
 from gql.transport.requests import RequestsHTTPTransport
 
+from logscalescim.directory import (
+    LOGSCALE_GQL_MUTATION_ASSIGN_GROUP_TO_CLUSTER_ROLE,
+    LOGSCALE_GQL_MUTATION_ASSIGN_GROUP_TO_ORGANIZATION_ROLE,
+    LOGSCALE_GQL_QUERY_ROLES,
+)
+
 import logging
 
 root = logging.getLogger()
@@ -21,25 +24,6 @@ formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(messag
 handler.setFormatter(formatter)
 root.addHandler(handler)
 
-LOGSCALE_GQL_MUTATION_ASSIGN_GROUP_TO_ORGANIZATION_ROLE = """mutation AssignOrganizationRoleToGroup($input: AssignOrganizationRoleToGroupInput!) {
-  assignOrganizationRoleToGroup(input: $input) {
-    group {
-      role {
-        displayName
-      }
-    }
-  }
-}"""
-LOGSCALE_GQL_MUTATION_ASSIGN_GROUP_TO_CLUSTER_ROLE = """mutation AssignSystemRoleToGroup($input: AssignSystemRoleToGroupInput!) {
-  assignSystemRoleToGroup(input: $input) {
-    group {
-      role {
-        id
-      }
-    }
-  }
-}"""
-
 LOGSCALE_GQL_MUTATION_ROLE_ADD = """mutation CreateRole($input: AddRoleInput!) {
   createRole(input: $input) {
     role {
@@ -57,13 +41,6 @@ LOGSCALE_GQL_MUTATION_ROLE_UPDATE = """mutation UpdateRole($input: UpdateRoleInp
   }
 }"""
 
-LOGSCALE_GQL_QUERY_ROLES = """query Roles {
-  roles {
-    id
-    displayName
-  }
-}"""
-
 LOGSCALE_GQL_QUERY_GROUP_BY_DISPLAY_NAME = """query GroupByDisplayName($displayName: String!) {
   groupByDisplayName(displayName: $displayName) {
     id    
@@ -111,9 +88,7 @@ LOGSCALE_API_TOKEN = os.environ.get(
     "LOGSCALE_API_TOKEN",
     "",
 )
-LOGSCALE_URL = os.environ.get(
-    "LOGSCALE_URL", ""
-)
+LOGSCALE_URL = os.environ.get("LOGSCALE_URL", "")
 LOGSCALE_ROLE_CLUSTER = os.environ.get(
     "LOGSCALE_ROLE_CLUSTER", "scim-management-cluster"
 )
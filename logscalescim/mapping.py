@@ -0,0 +1,390 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+LOGSCALE_SCIM_STATE_DB = os.environ.get(
+    "LOGSCALE_SCIM_STATE_DB",
+    os.path.join(tempfile.gettempdir(), "logscalescim.sqlite3"),
+)
+# how long the change feed keeps entries, older cursors need a full sync
+LOGSCALE_SCIM_CHANGE_RETENTION_SECONDS = int(
+    os.environ.get("LOGSCALE_SCIM_CHANGE_RETENTION_SECONDS", str(7 * 86400))
+)
+# skip writes that match what was last applied. Only correct when this
+# state db sees every write for the tenant, i.e. a single replica, and
+# edits made directly in LogScale then wait for the verifier to notice
+LOGSCALE_SCIM_SKIP_UNCHANGED = (
+    os.environ.get("LOGSCALE_SCIM_SKIP_UNCHANGED", "false").lower() == "true"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    tenant TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    logscale_id TEXT NOT NULL,
+    external_id TEXT,
+    user_name TEXT,
+    email TEXT,
+    display_name TEXT,
+    applied_hash TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (tenant, kind, logscale_id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS resources_external_id
+    ON resources (tenant, kind, external_id) WHERE external_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS resources_email ON resources (tenant, email);
+CREATE INDEX IF NOT EXISTS resources_display_name
+    ON resources (tenant, kind, display_name);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    tenant TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    logscale_id TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    changed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changes_tenant ON changes (tenant, seq);
+CREATE TABLE IF NOT EXISTS cursors (
+    tenant TEXT NOT NULL,
+    name TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (tenant, name)
+);
+"""
+
+USER = "User"
+GROUP = "Group"
+
+UPSERT = "upsert"
+DELETE = "delete"
+
+COLUMNS = ("external_id", "user_name", "email", "display_name", "applied_hash")
+
+
+def applied_hash(fields: dict) -> str:
+    """Stable digest of what was last sent to LogScale for a resource."""
+    canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def unchanged(mapped: dict, state: str) -> bool:
+    """Whether a write can be skipped as already applied to LogScale."""
+    return (
+        LOGSCALE_SCIM_SKIP_UNCHANGED
+        and mapped is not None
+        and mapped["applied_hash"] == state
+    )
+
+
+class MappingStore:
+    """Durable SCIM externalId <-> LogScale id mapping in a local SQLite file.
+
+    Connections are per thread and re-opened after fork; WAL mode lets the
+    gunicorn workers on a host read while one of them writes.
+    """
+
+    def __init__(self, path: str = LOGSCALE_SCIM_STATE_DB):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def _one(self, sql: str, params: tuple):
+        row = self.connection().execute(sql, params).fetchone()
+        return dict(row) if row is not None else None
+
+    def by_logscale_id(self, tenant: str, kind: str, logscale_id: str):
+        return self._one(
+            "SELECT * FROM resources WHERE tenant = ? AND kind = ? AND logscale_id = ?",
+            (tenant, kind, logscale_id),
+        )
+
+    def by_external_id(self, tenant: str, kind: str, external_id: str):
+        if not external_id:
+            return None
+        return self._one(
+            "SELECT * FROM resources WHERE tenant = ? AND kind = ? AND external_id = ?",
+            (tenant, kind, external_id),
+        )
+
+    def by_email(self, tenant: str, email: str, user_name: str = None):
+        # prefer the row that also matches the userName, like lookup_user_by_email
+        return self._one(
+            "SELECT * FROM resources WHERE tenant = ? AND kind = ? AND email = ? "
+            "ORDER BY user_name = ? DESC LIMIT 1",
+            (tenant, USER, email, user_name),
+        )
+
+    def by_display_name(self, tenant: str, kind: str, display_name: str):
+        return self._one(
+            "SELECT * FROM resources WHERE tenant = ? AND kind = ? AND display_name = ? "
+            "LIMIT 1",
+            (tenant, kind, display_name),
+        )
+
+    def _record(self, connection, tenant: str, kind: str, logscale_id: str, operation):
+        connection.execute(
+            "INSERT INTO changes (tenant, kind, logscale_id, operation, changed_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (tenant, kind, logscale_id, operation, time.time()),
+        )
+
+    def upsert(
+        self,
+        tenant: str,
+        kind: str,
+        logscale_id: str,
+        external_id: str = None,
+        user_name: str = None,
+        email: str = None,
+        display_name: str = None,
+        applied_hash: str = None,
+    ) -> bool:
+        """Record a resource, keeping existing columns that are passed as None.
+
+        A change is only added to the feed when a column actually changed;
+        returns whether it did.
+        """
+        values = dict(
+            external_id=external_id,
+            user_name=user_name,
+            email=email,
+            display_name=display_name,
+            applied_hash=applied_hash,
+        )
+        with self.connection() as connection:
+            row = connection.execute(
+                "SELECT * FROM resources WHERE tenant = ? AND kind = ? AND logscale_id = ?",
+                (tenant, kind, logscale_id),
+            ).fetchone()
+            if row is not None:
+                values = {
+                    column: row[column] if values[column] is None else values[column]
+                    for column in COLUMNS
+                }
+                if all(values[column] == row[column] for column in COLUMNS):
+                    return False
+            if external_id:
+                # the IdP identity moved to a different LogScale object
+                connection.execute(
+                    "DELETE FROM resources WHERE tenant = ? AND kind = ? "
+                    "AND external_id = ? AND logscale_id != ?",
+                    (tenant, kind, external_id, logscale_id),
+                )
+            connection.execute(
+                """INSERT OR REPLACE INTO resources (tenant, kind, logscale_id,
+                    external_id, user_name, email, display_name, applied_hash,
+                    updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (tenant, kind, logscale_id)
+                + tuple(values[column] for column in COLUMNS)
+                + (time.time(),),
+            )
+            self._record(connection, tenant, kind, logscale_id, UPSERT)
+        return True
+
+    def touch(self, tenant: str, kind: str, logscale_id: str):
+        """Add a change for a write that is not reflected in the row, like members."""
+        with self.connection() as connection:
+            self._record(connection, tenant, kind, logscale_id, UPSERT)
+
+    def delete(self, tenant: str, kind: str, logscale_id: str):
+        with self.connection() as connection:
+            connection.execute(
+                "DELETE FROM resources WHERE tenant = ? AND kind = ? AND logscale_id = ?",
+                (tenant, kind, logscale_id),
+            )
+            self._record(connection, tenant, kind, logscale_id, DELETE)
+
+    def last_seq(self, tenant: str) -> int:
+        row = (
+            self.connection()
+            .execute("SELECT max(seq) FROM changes WHERE tenant = ?", (tenant,))
+            .fetchone()
+        )
+        return row[0] or 0
+
+    def first_seq(self, tenant: str) -> int:
+        row = (
+            self.connection()
+            .execute("SELECT min(seq) FROM changes WHERE tenant = ?", (tenant,))
+            .fetchone()
+        )
+        return row[0] or 0
+
+    def changes_since(self, tenant: str, since: int, limit: int = 1000) -> list:
+        """The latest change of every resource written after sequence ``since``.
+
+        Rows are ordered by sequence, so the last ``seq`` returned is the
+        cursor to pass next time.
+        """
+        # sqlite takes the bare columns from the row holding max(seq)
+        rows = (
+            self.connection()
+            .execute(
+                """SELECT max(changes.seq) AS seq, changes.kind, changes.logscale_id,
+                changes.operation, changes.changed_at, resources.external_id,
+                resources.user_name, resources.email, resources.display_name
+            FROM changes LEFT JOIN resources ON resources.tenant = changes.tenant
+                AND resources.kind = changes.kind
+                AND resources.logscale_id = changes.logscale_id
+            WHERE changes.tenant = ? AND changes.seq > ?
+            GROUP BY changes.kind, changes.logscale_id
+            ORDER BY seq LIMIT ?""",
+                (tenant, since, limit),
+            )
+            .fetchall()
+        )
+        return [dict(row) for row in rows]
+
+    def claim(self, tenant: str, name: str, limit: int) -> list:
+        """Advance the ``name`` cursor over the next changes and return them.
+
+        The cursor is moved in the same transaction, so workers sharing the
+        database each get a different slice of the feed.
+        """
+        connection = self.connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT seq FROM cursors WHERE tenant = ? AND name = ?", (tenant, name)
+            ).fetchone()
+            since = row[0] if row is not None else 0
+            rows = self.changes_since(tenant, since, limit)
+            if rows:
+                connection.execute(
+                    "INSERT OR REPLACE INTO cursors (tenant, name, seq) VALUES (?, ?, ?)",
+                    (tenant, name, rows[-1]["seq"]),
+                )
+        return rows
+
+    def prune(self, tenant: str, older_than: float = None) -> int:
+        older_than = older_than or LOGSCALE_SCIM_CHANGE_RETENTION_SECONDS
+        with self.connection() as connection:
+            # keep the newest entry so the sequence never restarts
+            cursor = connection.execute(
+                "DELETE FROM changes WHERE tenant = ? AND changed_at < ? "
+                "AND seq < (SELECT max(seq) FROM changes WHERE tenant = ?)",
+                (tenant, time.time() - older_than, tenant),
+            )
+        return cursor.rowcount
+
+    def rebuild(self, tenant) -> int:
+        """Refresh every user and group of ``tenant`` from LogScale in one pass.
+
+        Rows for objects that no longer exist are dropped, while the
+        externalId and applied hash of surviving rows are kept.
+        """
+        from logscalescim.directory import iter_groups, iter_users
+
+        now = time.time()
+        count = 0
+        with self.connection() as connection:
+            connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS seen "
+                "(kind TEXT, logscale_id TEXT, PRIMARY KEY (kind, logscale_id))"
+            )
+            connection.execute("DELETE FROM seen")
+            for user in iter_users(tenant):
+                count += 1
+                connection.execute("INSERT INTO seen VALUES (?, ?)", (USER, user["id"]))
+                connection.execute(
+                    """INSERT INTO resources (tenant, kind, logscale_id, user_name,
+                        email, display_name, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (tenant, kind, logscale_id) DO UPDATE SET
+                        user_name = excluded.user_name,
+                        email = excluded.email,
+                        display_name = excluded.display_name,
+                        updated_at = excluded.updated_at""",
+                    (
+                        tenant.name,
+                        USER,
+                        user["id"],
+                        user["username"],
+                        user["email"],
+                        user["displayName"],
+                        now,
+                    ),
+                )
+            for group in iter_groups(tenant):
+                count += 1
+                connection.execute(
+                    "INSERT INTO seen VALUES (?, ?)", (GROUP, group["id"])
+                )
+                # groups_post stores the SCIM externalId as the lookupName
+                if group["lookupName"]:
+                    connection.execute(
+                        "UPDATE resources SET external_id = NULL WHERE tenant = ? "
+                        "AND kind = ? AND external_id = ? AND logscale_id != ?",
+                        (tenant.name, GROUP, group["lookupName"], group["id"]),
+                    )
+                connection.execute(
+                    """INSERT INTO resources (tenant, kind, logscale_id, external_id,
+                        display_name, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (tenant, kind, logscale_id) DO UPDATE SET
+                        external_id = coalesce(excluded.external_id, external_id),
+                        display_name = excluded.display_name,
+                        updated_at = excluded.updated_at""",
+                    (
+                        tenant.name,
+                        GROUP,
+                        group["id"],
+                        group["lookupName"],
+                        group["displayName"],
+                        now,
+                    ),
+                )
+            # objects removed outside of SCIM show up as deletes in the feed
+            connection.execute(
+                "INSERT INTO changes (tenant, kind, logscale_id, operation, "
+                "changed_at) SELECT tenant, kind, logscale_id, ?, ? FROM resources "
+                "WHERE tenant = ? AND NOT EXISTS (SELECT 1 FROM seen "
+                "WHERE seen.kind = resources.kind "
+                "AND seen.logscale_id = resources.logscale_id)",
+                (DELETE, now, tenant.name),
+            )
+            connection.execute(
+                "DELETE FROM resources WHERE tenant = ? AND NOT EXISTS (SELECT 1 "
+                "FROM seen WHERE seen.kind = resources.kind "
+                "AND seen.logscale_id = resources.logscale_id)",
+                (tenant.name,),
+            )
+        logging.info(f"Rebuilt mapping for tenant {tenant.name}: resources={count}")
+        return count
+
+
+store = MappingStore()
+
+
+def main():
+    """python -m logscalescim.mapping rebuild [tenant ...]"""
+    from logscalescim.tenants import DEFAULT_TENANT, tenants
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print(main.__doc__)
+        sys.exit(2)
+    for name in sys.argv[2:] or [DEFAULT_TENANT]:
+        store.rebuild(tenants.get(name))
+
+
+if __name__ == "__main__":
+    main()
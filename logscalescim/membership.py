@@ -0,0 +1,115 @@
+import logging
+
+
+from logscalescim.calls import CallBudgetExceeded, current
+from logscalescim.chunking import ChunkedExecutor, MembershipError
+from logscalescim.directory import directory_for
+from logscalescim.tenants import document
+
+LOGSCALE_GQL_MUTATION_GROUP_ADD_USERS = """mutation AddUsersToGroup($input: AddUsersToGroupInput!) {
+  addUsersToGroup(input: $input) {
+    group {
+      id
+      lookupName
+    }
+  }
+}"""
+
+LOGSCALE_GQL_MUTATION_GROUP_REMOVE_USERS = """mutation RemoveUsersFromGroup($input: RemoveUsersFromGroupInput!) {
+  removeUsersFromGroup(input: $input) {
+    group {
+      id
+    }
+  }
+}"""
+
+LOGSCALE_GQL_QUERY_GROUP_MEMBERS = """query GroupMembers($groupId: String!) {
+  group(groupId: $groupId) {
+    id
+    users {
+      id
+    }
+  }
+}"""
+
+
+def group_members(tenant, groupId: str) -> set:
+    """Current member ids of a group.
+
+    Kept in the tenant's directory once it is loaded, as compact arrays,
+    and in the "members" cache before that.
+    """
+    directory = directory_for(tenant)
+    if directory.loaded:
+        members = directory.members(groupId)
+    else:
+        members = tenant.cache("members").get(groupId)
+    if members is None:
+        result = tenant.execute(
+            document(LOGSCALE_GQL_QUERY_GROUP_MEMBERS),
+            variable_values={"groupId": groupId},
+        )
+        members = [user["id"] for user in result["group"]["users"]]
+        remember_members(tenant, groupId, members)
+    return set(members)
+
+
+def remember_members(tenant, groupId: str, members):
+    directory = directory_for(tenant)
+    if directory.loaded:
+        directory.set_members(groupId, members)
+    else:
+        tenant.cache("members").set(groupId, list(members))
+
+
+def forget_members(tenant, groupId: str):
+    tenant.cache("members").delete(groupId)
+    directory_for(tenant).forget_members(groupId)
+
+
+def update_members(tenant, groupId: str, mutation: str, users):
+    """Run a membership mutation over ``users`` in parallel chunks.
+
+    Raises MembershipError listing the members that could not be applied.
+    """
+    result = ChunkedExecutor(tenant).run(groupId, mutation, users)
+    logging.info(
+        f"Group {groupId} applied={result.applied} chunks={result.chunks} failed={len(result.failed)}"
+    )
+    context = current.get()
+    if context is not None and context.rejected:
+        raise CallBudgetExceeded(context)
+    if not result.ok:
+        raise MembershipError(result)
+    return result
+
+
+def replace_members(tenant, groupId: str, desired: set):
+    """Make the group's members exactly ``desired`` with the fewest mutations.
+
+    Only the net change is sent: one addUsersToGroup and one
+    removeUsersFromGroup per LOGSCALE_MEMBER_CHUNK_SIZE users.
+    Raises MembershipError when some members could not be applied.
+    """
+    current = group_members(tenant, groupId)
+    to_add = desired - current
+    to_remove = current - desired
+    logging.info(
+        f"Group {groupId} members={len(desired)} add={len(to_add)} remove={len(to_remove)}"
+    )
+
+    # invalidate first so a failure part way through is re-read next time
+    forget_members(tenant, groupId)
+    if to_add:
+        update_members(
+            tenant, groupId, LOGSCALE_GQL_MUTATION_GROUP_ADD_USERS, sorted(to_add)
+        )
+    if to_remove:
+        update_members(
+            tenant,
+            groupId,
+            LOGSCALE_GQL_MUTATION_GROUP_REMOVE_USERS,
+            sorted(to_remove),
+        )
+    remember_members(tenant, groupId, desired)
+    return to_add, to_remove
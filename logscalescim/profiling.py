@@ -0,0 +1,203 @@
+import io
+import logging
+import math
+import os
+import sys
+import threading
+from collections import Counter
+
+from flask.json.provider import DefaultJSONProvider
+
+from logscalescim.calls import phase
+
+# seconds between stack samples of a profiled request
+LOGSCALE_PROFILE_INTERVAL = float(os.environ.get("LOGSCALE_PROFILE_INTERVAL", "0.005"))
+# distinct stacks kept, further ones are counted under "[other]"
+LOGSCALE_PROFILE_MAX_STACKS = int(
+    os.environ.get("LOGSCALE_PROFILE_MAX_STACKS", "20000")
+)
+# frames kept per stack, counted from the request's outermost frame
+LOGSCALE_PROFILE_MAX_DEPTH = int(os.environ.get("LOGSCALE_PROFILE_MAX_DEPTH", "128"))
+
+SAMPLE = "sample"
+CPROFILE = "cprofile"
+MODES = (SAMPLE, CPROFILE)
+
+
+def folded(frame, depth: int = LOGSCALE_PROFILE_MAX_DEPTH) -> str:
+    """A stack as one "outer;...;inner" line of the folded flame graph format."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_qualname}")
+        frame = frame.f_back
+    return ";".join(reversed(names[-depth:]))
+
+
+class Sampler(threading.Thread):
+    """Samples the stack of one request thread until stopped."""
+
+    def __init__(self, target: int, interval: float):
+        super().__init__(name="logscalescim-sampler", daemon=True)
+        self.target = target
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is not None:
+                self.stacks[folded(frame)] += 1
+
+    def stop(self) -> Counter:
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+class Profiler:
+    """Profiles the next ``requests`` SCIM requests, of one route if given.
+
+    In "sample" mode a thread samples the request's stack every
+    LOGSCALE_PROFILE_INTERVAL seconds and the samples are kept as folded
+    stacks for flame graphs. "cprofile" mode runs cProfile, which only one
+    request at a time can use; requests arriving meanwhile are not
+    profiled. Nothing happens per request while the profiler is not armed.
+    """
+
+    def __init__(self):
+        self.armed = False
+        self.mode = SAMPLE
+        self.route = None
+        self.remaining = 0
+        self.interval = LOGSCALE_PROFILE_INTERVAL
+        self.profiled = 0
+        self.stacks = Counter()
+        self.stats = None
+        self.lock = threading.Lock()
+        self.cprofile_lock = threading.Lock()
+
+    def arm(self, mode: str, requests: int, route: str = None, interval: float = None):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}")
+        if requests < 1:
+            raise ValueError("requests must be at least 1")
+        # the sampler would spin on zero or less and die on anything else
+        if interval is not None and (
+            isinstance(interval, bool)
+            or not isinstance(interval, (int, float))
+            or not 0 < interval < math.inf
+        ):
+            raise ValueError("intervalSeconds must be a positive number")
+        with self.lock:
+            self.mode = mode
+            self.route = route
+            self.remaining = requests
+            self.interval = interval or LOGSCALE_PROFILE_INTERVAL
+            self.armed = True
+        logging.info(f"Profiling {requests} requests with {mode} route={route}")
+
+    def reset(self):
+        with self.lock:
+            self.armed = False
+            self.remaining = 0
+            self.profiled = 0
+            self.stacks = Counter()
+            self.stats = None
+
+    def start(self, method: str, rule: str):
+        """Begin profiling this request when it is selected, returns the capture."""
+        with self.lock:
+            if not self.armed or self.route not in (None, rule, f"{method} {rule}"):
+                return None
+            if self.mode == CPROFILE and not self.cprofile_lock.acquire(blocking=False):
+                return None
+            self.remaining -= 1
+            self.armed = self.remaining > 0
+            mode = self.mode
+            interval = self.interval
+        if mode == CPROFILE:
+            # only imported once someone asks for it
+            import cProfile
+
+            capture = cProfile.Profile()
+            capture.enable()
+            return capture
+        capture = Sampler(threading.get_ident(), interval)
+        capture.start()
+        return capture
+
+    def finish(self, capture):
+        if isinstance(capture, Sampler):
+            stacks = capture.stop()
+            with self.lock:
+                for stack, count in stacks.items():
+                    if stack not in self.stacks and len(self.stacks) >= (
+                        LOGSCALE_PROFILE_MAX_STACKS
+                    ):
+                        stack = "[other]"
+                    self.stacks[stack] += count
+                self.profiled += 1
+            return
+        import pstats
+
+        capture.disable()
+        self.cprofile_lock.release()
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(capture)
+            else:
+                self.stats.add(capture)
+            self.profiled += 1
+
+    def folded_stacks(self) -> str:
+        with self.lock:
+            return "".join(
+                f"{stack} {count}\n" for stack, count in self.stacks.most_common()
+            )
+
+    def report(self, sort: str = "cumulative", limit: int = 60) -> str:
+        """The cProfile statistics as text, most expensive first."""
+        out = io.StringIO()
+        with self.lock:
+            if self.stats is None:
+                return ""
+            self.stats.stream = out
+            self.stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "armed": self.armed,
+                "mode": self.mode,
+                "route": self.route,
+                "remaining": self.remaining,
+                "intervalSeconds": self.interval,
+                "profiled": self.profiled,
+                "stacks": len(self.stacks),
+            }
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, timing body parsing and serialization as phases."""
+
+    def loads(self, s, **kwargs):
+        with phase("parse"):
+            return super().loads(s, **kwargs)
+
+    def dumps(self, obj, **kwargs):
+        with phase("serialize"):
+            return super().dumps(obj, **kwargs)
+
+
+class TimedStreamHandler(logging.StreamHandler):
+    """Counts the time spent writing log records as the "logging" phase."""
+
+    def emit(self, record):
+        with phase("logging"):
+            super().emit(record)
+
+
+profiler = Profiler()
@@ -0,0 +1,160 @@
+import logging
+import os
+import threading
+
+from logscalescim.mapping import DELETE, GROUP, store
+from logscalescim.tenants import LogScaleQueryError, document
+
+# 0 disables the background verifier
+LOGSCALE_SCIM_VERIFY_SECONDS = int(os.environ.get("LOGSCALE_SCIM_VERIFY_SECONDS", "60"))
+LOGSCALE_SCIM_VERIFY_BATCH = int(os.environ.get("LOGSCALE_SCIM_VERIFY_BATCH", "200"))
+
+VERIFIER = "verifier"
+
+LOGSCALE_GQL_QUERY_GROUP_STATE = """query GroupState($groupId: String!) {
+  group(groupId: $groupId) {
+    id
+    displayName
+    lookupName
+  }
+}"""
+
+LOGSCALE_GQL_QUERY_USER_STATE = """query UserState($search: String) {
+  users(search: $search) {
+    id
+    username
+    email
+  }
+}"""
+
+
+def logscale_state(tenant, kind: str, row: dict):
+    """The resource as LogScale has it now, or None when it does not exist."""
+    if kind == GROUP:
+        try:
+            result = tenant.execute(
+                document(LOGSCALE_GQL_QUERY_GROUP_STATE),
+                variable_values={"groupId": row["logscale_id"]},
+            )
+        except LogScaleQueryError:
+            # LogScale reports an unknown group id as a query error
+            return None
+        group = result["group"]
+        if group is None:
+            return None
+        return {
+            "display_name": group["displayName"],
+            "external_id": group["lookupName"],
+        }
+
+    search = row["user_name"] or row["email"]
+    if not search:
+        return None
+    result = tenant.execute(
+        document(LOGSCALE_GQL_QUERY_USER_STATE), variable_values={"search": search}
+    )
+    for user in result["users"]:
+        if user["id"] == row["logscale_id"]:
+            return {"user_name": user["username"], "email": user["email"]}
+    return None
+
+
+def verify(tenant, change: dict) -> bool:
+    """Compare one changed resource with LogScale; returns False on drift."""
+    kind = change["kind"]
+    state = logscale_state(tenant, kind, change)
+
+    if change["operation"] == DELETE:
+        if state is not None:
+            logging.warning(
+                f"Drift in {tenant.name}: deleted {kind} {change['logscale_id']} still exists"
+            )
+            return False
+        return True
+
+    if state is None:
+        logging.warning(
+            f"Drift in {tenant.name}: {kind} {change['logscale_id']} no longer exists"
+        )
+        store.delete(tenant.name, kind, change["logscale_id"])
+        return False
+
+    differs = [
+        column
+        for column, value in state.items()
+        if change[column] is not None and change[column] != value
+    ]
+    if differs:
+        logging.warning(
+            f"Drift in {tenant.name}: {kind} {change['logscale_id']} differs in {', '.join(differs)}"
+        )
+        # the next push from the IdP is applied instead of skipped
+        store.upsert(tenant.name, kind, change["logscale_id"], applied_hash="")
+        return False
+    return True
+
+
+def verify_recent(tenant, limit: int = None) -> tuple:
+    """Check the resources changed since the verifier last ran.
+
+    The work done is proportional to the rate of change rather than the
+    directory size. Returns the number of resources checked and drifted.
+    """
+    changes = store.claim(tenant.name, VERIFIER, limit or LOGSCALE_SCIM_VERIFY_BATCH)
+    drifted = 0
+    for change in changes:
+        try:
+            if not verify(tenant, change):
+                drifted += 1
+        except Exception:
+            logging.exception(f"Verifying {change['kind']} {change['logscale_id']}")
+    if changes:
+        logging.info(
+            f"Verified tenant {tenant.name}: checked={len(changes)} drifted={drifted}"
+        )
+    return len(changes), drifted
+
+
+class Verifier(threading.Thread):
+    """Runs verify_recent for every tenant in use in the background."""
+
+    def __init__(self, registry, interval: int = LOGSCALE_SCIM_VERIFY_SECONDS):
+        super().__init__(name="logscalescim-verifier", daemon=True)
+        self.registry = registry
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for name in list(self.registry.configs):
+                try:
+                    # only tenants in use, creating the others would keep
+                    # them from ever being evicted as idle
+                    tenant = self.registry.active.get(name)
+                    # drain the backlog, a batch at a time
+                    while (
+                        tenant is not None
+                        and verify_recent(tenant)[0] >= LOGSCALE_SCIM_VERIFY_BATCH
+                    ):
+                        if self.stopped.is_set():
+                            return
+                    store.prune(name)
+                except Exception:
+                    logging.exception(f"Verifier failed for tenant {name}")
+
+    def stop(self):
+        self.stopped.set()
+
+
+_verifier = None
+
+
+def start_verifier(registry):
+    """Start the verifier once per process, when enabled."""
+    global _verifier
+    if LOGSCALE_SCIM_VERIFY_SECONDS <= 0:
+        return None
+    if _verifier is None or not _verifier.is_alive():
+        _verifier = Verifier(registry)
+        _verifier.start()
+    return _verifier
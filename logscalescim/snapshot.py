@@ -0,0 +1,514 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from logscalescim.chunking import MembershipError, chunks
+from logscalescim.directory import (
+    LOGSCALE_GQL_MUTATION_ASSIGN_GROUP_TO_CLUSTER_ROLE,
+    LOGSCALE_GQL_MUTATION_ASSIGN_GROUP_TO_ORGANIZATION_ROLE,
+    LOGSCALE_GQL_MUTATION_GROUP_ADD,
+    LOGSCALE_GQL_MUTATION_USER_ADD,
+    iter_groups,
+    iter_pages,
+    iter_roles,
+    iter_users,
+)
+from logscalescim.membership import (
+    LOGSCALE_GQL_MUTATION_GROUP_ADD_USERS,
+    update_members,
+)
+from logscalescim.tenants import (
+    DEFAULT_TENANT,
+    CircuitBreaker,
+    LogScaleQueryError,
+    document,
+    tenants,
+)
+
+# records applied at once while importing, and the checkpoint interval
+LOGSCALE_SNAPSHOT_WINDOW = int(os.environ.get("LOGSCALE_SNAPSHOT_WINDOW", "500"))
+LOGSCALE_SNAPSHOT_PARALLELISM = int(
+    os.environ.get("LOGSCALE_SNAPSHOT_PARALLELISM", "8")
+)
+
+VERSION = 1
+
+LOGSCALE_GQL_QUERY_SNAPSHOT_USERS_PAGE = """query SnapshotUsersPage($pageNumber: Int!, $pageSize: Int!) {
+  usersPage(pageNumber: $pageNumber, pageSize: $pageSize) {
+    pageInfo {
+      nextNumber
+    }
+    page {
+      id
+      username
+      email
+      displayName
+      fullName
+      firstName
+      lastName
+    }
+  }
+}"""
+
+LOGSCALE_GQL_QUERY_SNAPSHOT_GROUP = """query SnapshotGroup($groupId: String!) {
+  group(groupId: $groupId) {
+    users {
+      id
+    }
+    organizationRoles {
+      role {
+        id
+      }
+    }
+    systemRoles {
+      role {
+        id
+      }
+    }
+  }
+}"""
+
+USER = "user"
+GROUP = "group"
+ROLE = "role"
+MEMBERS = "members"
+
+CHECKPOINT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ids (
+    kind TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    target_id TEXT NOT NULL,
+    PRIMARY KEY (kind, source_id)
+);
+CREATE TABLE IF NOT EXISTS target (
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (kind, name)
+);
+CREATE TABLE IF NOT EXISTS progress (
+    snapshot TEXT PRIMARY KEY,
+    line INTEGER NOT NULL
+);
+"""
+
+
+def open_snapshot(path: str, mode: str, name: str = None):
+    """Snapshots are newline-delimited JSON, gzip compressed when named *.gz."""
+    if (name or path).endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def export_snapshot(tenant, path: str, page_size: int = None) -> dict:
+    """Write every user, role, group, group role and membership of ``tenant``.
+
+    Records are written as they are read, one LogScale page or group at a
+    time, and member lists are split into records of at most
+    LOGSCALE_MEMBER_CHUNK_SIZE ids, so memory does not grow with the
+    directory. Roles come before groups and all groups before all members,
+    which is the order an import needs them in and lets it apply each kind
+    in full windows. Members are spooled to a temporary file while the
+    groups are written. The file only appears under ``path`` once it is
+    complete.
+    """
+    counts = {USER: 0, ROLE: 0, GROUP: 0, MEMBERS: 0}
+    partial = f"{path}.partial"
+    with open_snapshot(partial, "w", name=path) as out, tempfile.TemporaryFile(
+        "w+", encoding="utf-8", dir=os.path.dirname(os.path.abspath(path))
+    ) as members:
+
+        def write(record, to=out):
+            to.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+        write(
+            {
+                "type": "snapshot",
+                "version": VERSION,
+                "tenant": tenant.name,
+                "createdAt": time.time(),
+            }
+        )
+        for user in iter_pages(
+            tenant,
+            LOGSCALE_GQL_QUERY_SNAPSHOT_USERS_PAGE,
+            "usersPage",
+            page_size,
+        ):
+            write({"type": USER, **user})
+            counts[USER] += 1
+        for role in iter_roles(tenant):
+            write({"type": ROLE, **role})
+            counts[ROLE] += 1
+        query = document(LOGSCALE_GQL_QUERY_SNAPSHOT_GROUP)
+        for group in iter_groups(tenant, page_size):
+            detail = tenant.execute(query, variable_values={"groupId": group["id"]})
+            detail = detail["group"]
+            write(
+                {
+                    "type": GROUP,
+                    **group,
+                    "organizationRoles": [
+                        assigned["role"]["id"]
+                        for assigned in detail["organizationRoles"]
+                    ],
+                    "systemRoles": [
+                        assigned["role"]["id"] for assigned in detail["systemRoles"]
+                    ],
+                }
+            )
+            counts[GROUP] += 1
+            for users in chunks(user["id"] for user in detail["users"]):
+                write(
+                    {"type": MEMBERS, "group": group["id"], "users": users},
+                    to=members,
+                )
+                counts[MEMBERS] += len(users)
+            if counts[GROUP] % 1000 == 0:
+                logging.info(f"Exported {counts[GROUP]} groups")
+        members.seek(0)
+        shutil.copyfileobj(members, out)
+        write({"type": "end", "counts": counts})
+    os.replace(partial, path)
+    logging.info(f"Exported tenant {tenant.name} to {path}: {counts}")
+    return counts
+
+
+class Checkpoint:
+    """Progress of an import, kept in a SQLite file so it can be resumed.
+
+    Holds the target id of every user, group and role applied so far, the
+    last snapshot line whose window was fully applied, and an index of the
+    objects that already exist in the target by name.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(CHECKPOINT_SCHEMA)
+            self.local.connection = connection
+        return connection
+
+    def line(self, snapshot: str) -> int:
+        row = (
+            self.connection()
+            .execute("SELECT line FROM progress WHERE snapshot = ?", (snapshot,))
+            .fetchone()
+        )
+        return row[0] if row is not None else 0
+
+    def target_id(self, kind: str, source_id: str):
+        row = (
+            self.connection()
+            .execute(
+                "SELECT target_id FROM ids WHERE kind = ? AND source_id = ?",
+                (kind, source_id),
+            )
+            .fetchone()
+        )
+        return row[0] if row is not None else None
+
+    def target_ids(self, kind: str, source_ids: list) -> list:
+        if not source_ids:
+            return []
+        placeholders = ",".join("?" * len(source_ids))
+        return [
+            row[0]
+            for row in self.connection().execute(
+                f"SELECT target_id FROM ids WHERE kind = ? AND source_id IN ({placeholders})",
+                (kind, *source_ids),
+            )
+        ]
+
+    def existing(self, kind: str, name: str):
+        if not name:
+            return None
+        row = (
+            self.connection()
+            .execute("SELECT id FROM target WHERE kind = ? AND name = ?", (kind, name))
+            .fetchone()
+        )
+        return row[0] if row is not None else None
+
+    def index_target(self, tenant, page_size: int = None):
+        """Record what already exists in the target, to match rather than add."""
+        with self.connection() as connection:
+            connection.execute("DELETE FROM target")
+            connection.executemany(
+                "INSERT OR IGNORE INTO target VALUES (?, ?, ?)",
+                (
+                    (USER, user["username"], user["id"])
+                    for user in iter_users(tenant, page_size)
+                ),
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO target VALUES (?, ?, ?)",
+                (
+                    (GROUP, group["displayName"], group["id"])
+                    for group in iter_groups(tenant, page_size)
+                ),
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO target VALUES (?, ?, ?)",
+                (
+                    (ROLE, role["displayName"], role["id"])
+                    for role in iter_roles(tenant)
+                ),
+            )
+
+    def save(self, snapshot: str, ids: list, line: int = None):
+        """Store applied ids, and advance to ``line`` when its window is done."""
+        with self.connection() as connection:
+            connection.executemany("INSERT OR REPLACE INTO ids VALUES (?, ?, ?)", ids)
+            if line is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO progress VALUES (?, ?)", (snapshot, line)
+                )
+
+
+class Importer:
+    """Applies a snapshot to a tenant through the normal mutation paths.
+
+    Records are applied in windows of LOGSCALE_SNAPSHOT_WINDOW, ``parallelism``
+    at a time, with members going through the chunked membership mutations.
+    Users, groups and roles that already exist in the target are matched by
+    username or displayName instead of added. A record LogScale rejects is
+    logged and skipped; any other failure stops the import, and running it
+    again resumes after the last window that completed.
+    """
+
+    def __init__(
+        self,
+        tenant,
+        checkpoint: Checkpoint,
+        parallelism: int = LOGSCALE_SNAPSHOT_PARALLELISM,
+        window: int = LOGSCALE_SNAPSHOT_WINDOW,
+    ):
+        self.tenant = tenant
+        self.checkpoint = checkpoint
+        self.parallelism = max(1, parallelism)
+        self.window = window
+        self.counts = {"applied": 0, "matched": 0, "skipped": 0, "rejected": 0}
+        self.lock = threading.Lock()
+
+    def count(self, outcome: str):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def apply_user(self, record):
+        target = self.checkpoint.target_id(USER, record["id"])
+        if target is not None:
+            self.count("skipped")
+            return None
+        target = self.checkpoint.existing(USER, record["username"])
+        if target is not None:
+            self.count("matched")
+            return (USER, record["id"], target)
+        fields = {
+            key: record[key]
+            for key in ("username", "email", "fullName", "firstName", "lastName")
+            if record.get(key)
+        }
+        result = self.tenant.execute(
+            document(LOGSCALE_GQL_MUTATION_USER_ADD),
+            variable_values={"input": fields},
+        )
+        self.count("applied")
+        return (USER, record["id"], result["addUserV2"]["id"])
+
+    def apply_role(self, record):
+        # roles are matched by name only, their permissions are not exported
+        target = self.checkpoint.existing(ROLE, record["displayName"])
+        if target is None:
+            logging.warning(f"Role {record['displayName']} does not exist in target")
+            self.count("rejected")
+            return None
+        self.count("matched")
+        return (ROLE, record["id"], target)
+
+    def apply_group(self, record):
+        target = self.checkpoint.target_id(GROUP, record["id"])
+        if target is not None:
+            self.count("skipped")
+            return None
+        target = self.checkpoint.existing(GROUP, record["displayName"])
+        if target is not None:
+            self.count("matched")
+        else:
+            result = self.tenant.execute(
+                document(LOGSCALE_GQL_MUTATION_GROUP_ADD),
+                variable_values={
+                    "displayName": record["displayName"],
+                    "lookupName": record.get("lookupName"),
+                },
+            )
+            target = result["addGroup"]["group"]["id"]
+            self.count("applied")
+        for mutation, roles in (
+            (
+                LOGSCALE_GQL_MUTATION_ASSIGN_GROUP_TO_ORGANIZATION_ROLE,
+                record.get("organizationRoles", []),
+            ),
+            (
+                LOGSCALE_GQL_MUTATION_ASSIGN_GROUP_TO_CLUSTER_ROLE,
+                record.get("systemRoles", []),
+            ),
+        ):
+            for role in roles:
+                roleId = self.checkpoint.target_id(ROLE, role)
+                if roleId is None:
+                    continue
+                try:
+                    self.tenant.execute(
+                        document(mutation),
+                        variable_values={
+                            "input": {"groupId": target, "roleId": roleId}
+                        },
+                    )
+                except LogScaleQueryError as e:
+                    logging.warning(
+                        f"Role {roleId} not assigned to group {record['displayName']}: {e}"
+                    )
+        return (GROUP, record["id"], target)
+
+    def apply_members(self, record):
+        groupId = self.checkpoint.target_id(GROUP, record["group"])
+        if groupId is None:
+            logging.warning(f"Members of unknown group {record['group']} skipped")
+            self.count("rejected")
+            return None
+        users = self.checkpoint.target_ids(USER, record["users"])
+        try:
+            update_members(
+                self.tenant, groupId, LOGSCALE_GQL_MUTATION_GROUP_ADD_USERS, users
+            )
+        except MembershipError as e:
+            if self.tenant.breaker.state != CircuitBreaker.CLOSED:
+                raise
+            logging.warning(f"Group {groupId} {e}")
+            self.count("rejected")
+            return None
+        self.count("applied")
+        return None
+
+    def apply(self, record):
+        try:
+            return getattr(self, f"apply_{record['type']}")(record)
+        except LogScaleQueryError as e:
+            logging.warning(f"{record['type']} {record.get('id', '')} rejected: {e}")
+            self.count("rejected")
+            return None
+
+    def run(self, path: str, page_size: int = None) -> dict:
+        self.checkpoint.index_target(self.tenant, page_size)
+        resume = self.checkpoint.line(path)
+        if resume:
+            logging.info(f"Resuming {path} after line {resume}")
+        with open_snapshot(path, "r") as source, ThreadPoolExecutor(
+            max_workers=self.parallelism
+        ) as pool:
+            window = []
+            complete = False
+            number = 0
+            for number, line in enumerate(source, 1):
+                if number <= resume:
+                    continue
+                record = json.loads(line)
+                if record["type"] == "snapshot":
+                    if record["version"] != VERSION:
+                        raise ValueError(
+                            f"Unsupported snapshot version {record['version']}"
+                        )
+                    continue
+                if record["type"] == "end":
+                    complete = True
+                    continue
+                # a window never spans two record types, users must all be
+                # applied before the memberships that refer to them, so older
+                # snapshots with members after each group import one group
+                # per window
+                if window and (
+                    record["type"] != window[0]["type"] or len(window) >= self.window
+                ):
+                    self.flush(pool, path, window, number - 1)
+                    window = []
+                window.append(record)
+            self.flush(pool, path, window, number)
+        if not complete:
+            logging.warning(f"{path} has no end record, the export may be truncated")
+        logging.info(f"Imported {path} into tenant {self.tenant.name}: {self.counts}")
+        return self.counts
+
+    def flush(self, pool, path: str, window: list, line: int):
+        futures = [pool.submit(self.apply, record) for record in window]
+        ids = []
+        error = None
+        for future in futures:
+            try:
+                applied = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            if applied is not None:
+                ids.append(applied)
+        # ids applied before a failure are kept, the window is retried on resume
+        self.checkpoint.save(path, ids, None if error else line)
+        if error is not None:
+            raise error
+        if window:
+            logging.info(f"Applied {path} through line {line}: {self.counts}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    parser = argparse.ArgumentParser(
+        prog="python -m logscalescim.snapshot",
+        description="Export or import the users, groups, memberships and role "
+        "assignments of a LogScale tenant.",
+    )
+    parser.add_argument("--tenant", default=DEFAULT_TENANT)
+    parser.add_argument("--page-size", type=int, default=None)
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export")
+    export.add_argument("path")
+    load = commands.add_parser("import")
+    load.add_argument("path")
+    load.add_argument(
+        "--checkpoint", help="progress file, defaults to <path>.checkpoint"
+    )
+    load.add_argument("--parallelism", type=int, default=LOGSCALE_SNAPSHOT_PARALLELISM)
+    args = parser.parse_args()
+
+    tenant = tenants.get(args.tenant)
+    try:
+        if args.command == "export":
+            export_snapshot(tenant, args.path, args.page_size)
+        else:
+            checkpoint = Checkpoint(args.checkpoint or f"{args.path}.checkpoint")
+            counts = Importer(tenant, checkpoint, args.parallelism).run(
+                args.path, args.page_size
+            )
+            if counts["rejected"]:
+                sys.exit(1)
+    finally:
+        tenant.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import codecs
+import json
+import os
+
+from logscalescim.calls import phase
+
+# largest request body accepted, larger ones are answered with 413
+LOGSCALE_SCIM_MAX_CONTENT_LENGTH = int(
+    os.environ.get("LOGSCALE_SCIM_MAX_CONTENT_LENGTH", str(64 * 1024 * 1024))
+)
+LOGSCALE_SCIM_STREAM_CHUNK_SIZE = int(
+    os.environ.get("LOGSCALE_SCIM_STREAM_CHUNK_SIZE", "65536")
+)
+
+WHITESPACE = " \t\r\n"
+NUMBER = "0123456789+-.eE"
+
+
+class StreamError(ValueError):
+    """The request body is not the JSON document it was expected to be."""
+
+
+class JsonReader:
+    """Pull parser over a binary stream, for documents too big to load whole.
+
+    Containers are walked with ``keys()`` and ``elements()``, which yield
+    once per entry and leave the reader positioned on its value. The caller
+    consumes exactly one value per entry with ``value()``, ``keys()`` or
+    ``elements()``. Scalars and small containers are decoded with the
+    standard library decoder, so only one chunk of the body is buffered at a
+    time plus the value being decoded. A value that does not fit is read in
+    chunks that double in size, so it is decoded a logarithmic number of
+    times rather than once per chunk.
+    """
+
+    def __init__(self, stream, chunk_size: int = LOGSCALE_SCIM_STREAM_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size: int = 0) -> bool:
+        if self.eof:
+            return False
+        data = self.stream.read(size or self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        # drop what was consumed so the buffer stays around one chunk
+        self.buffer = self.buffer[self.pos :] + self.text.decode(data)
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """The next non-whitespace character, or "" at the end of the body."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise StreamError(f"Expected {char!r} but found {found!r}")
+        self.pos += 1
+
+    def value(self):
+        """Decode the complete JSON value at the current position."""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                if self._fill(size):
+                    size *= 2
+                    continue
+                raise StreamError(str(e)) from e
+            # a number ending the buffer may continue in the next chunk, also
+            # when its fraction or exponent was cut, as in "-0." or "1e"
+            if (
+                isinstance(value, (int, float))
+                and not self.buffer[end:].strip(NUMBER)
+                and self._fill()
+            ):
+                continue
+            self.pos = end
+            return value
+
+    def _separator(self, close: str) -> bool:
+        found = self.peek()
+        self.pos += 1
+        if found == close:
+            return False
+        if found != ",":
+            raise StreamError(f"Expected ',' or {close!r} but found {found!r}")
+        return True
+
+    def keys(self):
+        """Yield the keys of the object at the current position."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise StreamError(f"Expected an object key but found {key!r}")
+            self.expect(":")
+            yield key
+            if not self._separator("}"):
+                return
+
+    def elements(self):
+        """Yield once for every element of the array at the current position."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if not self._separator("]"):
+                return
+
+    def items(self):
+        for _ in self.elements():
+            yield self.value()
+
+
+def timed(iterator):
+    """Yield from ``iterator``, counting each step as the "parse" phase.
+
+    Only the pulls are timed, not what the consumer does in between, which
+    for member lists is mostly waiting on LogScale.
+    """
+    iterator = iter(iterator)
+    while True:
+        with phase("parse"):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+def iter_patch_operations(stream):
+    """Yield the operations of a PatchOp body one at a time.
+
+    The "value" array of a members operation is not decoded up front; it is
+    an iterator over the member objects that reads the body as it goes, so a
+    PatchOp with tens of thousands of members can be fed straight into the
+    chunked membership path. That needs "op" and "path" to come before
+    "value", as every IdP we know sends them; otherwise the value is decoded
+    whole. An iterator that is not exhausted is skipped over when the next
+    operation is requested.
+    """
+    return timed(_patch_operations(stream))
+
+
+def _patch_operations(stream):
+    reader = JsonReader(stream)
+    for key in reader.keys():
+        if key != "Operations":
+            reader.value()
+            continue
+        for _ in reader.elements():
+            operation = {}
+            streamed = False
+            for field in reader.keys():
+                if (
+                    field == "value"
+                    and "op" in operation
+                    and operation.get("path") == "members"
+                    and reader.peek() == "["
+                ):
+                    values = reader.items()
+                    yield {**operation, "value": timed(values)}
+                    streamed = True
+                    # already inside a timed step, skip the rest untimed
+                    for _ in values:
+                        pass
+                else:
+                    operation[field] = reader.value()
+            if not streamed:
+                yield operation
+
+
+def read_group(stream) -> dict:
+    """Read a Group resource with its "members" reduced to a set of member ids.
+
+    Only the ids are kept, which is all the membership update needs.
+    """
+    with phase("parse"):
+        reader = JsonReader(stream)
+        group = {}
+        for key in reader.keys():
+            if key == "members":
+                group[key] = {member["value"] for member in reader.items()}
+            else:
+                group[key] = reader.value()
+        return group
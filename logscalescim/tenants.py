@@ -0,0 +1,460 @@
+import json
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+
+from logscalescim.cache import drop_cache, make_cache
+from logscalescim.calls import current, phase, tracked
+from logscalescim.dispatch import BULK, dispatcher
+
+LOGSCALE_API_TOKEN = os.environ.get(
+    "LOGSCALE_API_TOKEN",
+    "",
+)
+LOGSCALE_URL = os.environ.get("LOGSCALE_URL", "")
+LOGSCALE_TENANTS_FILE = os.environ.get("LOGSCALE_TENANTS_FILE", "")
+LOGSCALE_TENANT_IDLE_SECONDS = float(
+    os.environ.get("LOGSCALE_TENANT_IDLE_SECONDS", "900")
+)
+LOGSCALE_TENANT_MAX_CONCURRENCY = int(
+    os.environ.get("LOGSCALE_TENANT_MAX_CONCURRENCY", "8")
+)
+LOGSCALE_TRANSPORT_RETRIES = int(os.environ.get("LOGSCALE_TRANSPORT_RETRIES", "3"))
+# consecutive transport failures that open a tenant's circuit
+LOGSCALE_CIRCUIT_FAILURES = int(os.environ.get("LOGSCALE_CIRCUIT_FAILURES", "5"))
+LOGSCALE_CIRCUIT_RESET_SECONDS = float(
+    os.environ.get("LOGSCALE_CIRCUIT_RESET_SECONDS", "30")
+)
+LOGSCALE_PROBE_CACHE_SECONDS = float(
+    os.environ.get("LOGSCALE_PROBE_CACHE_SECONDS", "5")
+)
+LOGSCALE_PROBE_TIMEOUT_SECONDS = float(
+    os.environ.get("LOGSCALE_PROBE_TIMEOUT_SECONDS", "2")
+)
+
+LOGSCALE_GQL_QUERY_PROBE = """query Probe {
+  meta {
+    version
+  }
+}"""
+
+DEFAULT_TENANT = "default"
+
+
+class UnknownTenant(KeyError):
+    pass
+
+
+class LogScaleQueryError(Exception):
+    """LogScale rejected a GraphQL request; ``errors`` is the GraphQL error list.
+
+    Raised instead of gql's TransportQueryError so request handlers do not
+    have to import gql, which is only loaded once a tenant connects.
+    """
+
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+class CircuitOpen(Exception):
+    """LogScale calls for a tenant are suspended after repeated transport failures."""
+
+    def __init__(self, tenant: str, retry_after: float):
+        super().__init__(
+            f"LogScale for tenant {tenant} is unavailable, retrying in {retry_after:.1f}s"
+        )
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calling a LogScale that keeps failing at the transport level.
+
+    After ``failures`` consecutive transport errors the circuit opens and
+    calls fail fast for ``reset_seconds``; then a single trial call is let
+    through, which closes the circuit again on success. GraphQL errors
+    mean LogScale answered and count as successes.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        failures: int = LOGSCALE_CIRCUIT_FAILURES,
+        reset_seconds: float = LOGSCALE_CIRCUIT_RESET_SECONDS,
+    ):
+        self.threshold = failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        # ident of the thread making the trial call while half-open
+        self.trial = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self) -> float:
+        """0 when a call may go ahead, otherwise the seconds until it may."""
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            remaining = self.reset_seconds - (time.monotonic() - self.opened_at)
+            if remaining > 0:
+                return remaining
+            if self.trial:
+                # only one trial call at a time while half-open
+                return 1.0
+            self.trial = threading.get_ident()
+            return 0.0
+
+    def cancel(self):
+        """Give up this thread's trial call when it never reached LogScale."""
+        with self.lock:
+            if self.trial == threading.get_ident():
+                self.trial = None
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = None
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+@lru_cache(maxsize=None)
+def _parse(source: str):
+    from gql import gql
+
+    return gql(source)
+
+
+def document(source: str):
+    """Parse a GraphQL document once per process instead of once per request."""
+    with phase("document"):
+        return _parse(source)
+
+
+class Tenant:
+    """One LogScale cluster/organization with its own transport and limits.
+
+    The gql session is opened lazily and kept open so the underlying
+    requests.Session can reuse its connection pool across SCIM requests.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        api_token: str,
+        max_concurrency: int = LOGSCALE_TENANT_MAX_CONCURRENCY,
+        verify: bool = False,
+        weight: float = 1.0,
+    ):
+        self.name = name
+        self.url = url
+        self.api_token = api_token
+        self.verify = verify
+        self.max_concurrency = max_concurrency
+        self.weight = weight
+        self.in_flight = 0
+        self.last_used = time.monotonic()
+        self.caches = {}
+        self.client = None
+        self.session = None
+        self.lock = threading.Lock()
+        self.counter_lock = threading.Lock()
+        self.breaker = CircuitBreaker()
+        self.probed = None
+        self.probed_at = 0.0
+        self.probe_lock = threading.Lock()
+
+    def connect(self):
+        with self.lock:
+            if self.session is None:
+                from gql import Client
+                from gql.transport.requests import RequestsHTTPTransport
+
+                headers = {"Authorization": f"Bearer {self.api_token}"}
+                transport = RequestsHTTPTransport(
+                    url=self.url,
+                    verify=self.verify,
+                    retries=LOGSCALE_TRANSPORT_RETRIES,
+                    headers=headers,
+                )
+                self.client = Client(
+                    transport=transport, fetch_schema_from_transport=False
+                )
+                self.session = self.client.connect_sync()
+                logging.info(f"Tenant {self.name} connected to {self.url}")
+            return self.session
+
+    def execute(
+        self, document, variable_values=None, priority=None, touch=None, **kwargs
+    ):
+        """Run a GraphQL document against this tenant's LogScale.
+
+        Only calls made for a SCIM request reset the idle clock by default,
+        so the warmer, verifier and health probe do not keep an otherwise
+        unused tenant connected.
+        """
+        from gql.transport.exceptions import TransportQueryError
+
+        if touch is None:
+            touch = current.get() is not None
+        if touch:
+            self.last_used = time.monotonic()
+        wait = self.breaker.allow()
+        if wait:
+            raise CircuitOpen(self.name, wait)
+        try:
+            if priority is None:
+                context = current.get()
+                priority = BULK if context is None else context.priority
+            slot = dispatcher.slot(
+                self.name, self.max_concurrency, priority, self.weight
+            )
+            with tracked(self.name, document), slot:
+                with self.counter_lock:
+                    self.in_flight += 1
+                try:
+                    session = self.session or self.connect()
+                    result = session.execute(
+                        document, variable_values=variable_values, **kwargs
+                    )
+                except TransportQueryError as e:
+                    self.breaker.success()
+                    raise LogScaleQueryError(str(e), e.errors) from e
+                except Exception:
+                    self.breaker.failure()
+                    raise
+                else:
+                    self.breaker.success()
+                    return result
+                finally:
+                    with self.counter_lock:
+                        self.in_flight -= 1
+                    if touch:
+                        self.last_used = time.monotonic()
+        finally:
+            # a trial call stopped before it got an answer, e.g. by the
+            # request's call budget, must not leave the circuit half-open
+            self.breaker.cancel()
+
+    def probe(self) -> dict:
+        """Whether LogScale answered a trivial query, as of the last probe.
+
+        Never waits on LogScale: a result older than
+        LOGSCALE_PROBE_CACHE_SECONDS is refreshed in the background and the
+        previous one returned meanwhile. Only one probe per tenant runs at a
+        time.
+        """
+        if (
+            self.probed is None
+            or time.monotonic() - self.probed_at >= LOGSCALE_PROBE_CACHE_SECONDS
+        ) and self.probe_lock.acquire(blocking=False):
+            threading.Thread(
+                target=self._probe, name=f"probe-{self.name}", daemon=True
+            ).start()
+        return self.probed or {"reachable": False, "error": "probe in progress"}
+
+    def _probe(self):
+        """Send the probe query once, without retries.
+
+        It does not go through execute(), so it neither queues for a
+        dispatcher slot nor goes through the transport's retries, and an
+        unreachable LogScale is reported after LOGSCALE_PROBE_TIMEOUT_SECONDS.
+        """
+        import requests
+
+        try:
+            started = time.perf_counter()
+            error = None
+            try:
+                response = requests.post(
+                    self.url,
+                    json={"query": LOGSCALE_GQL_QUERY_PROBE},
+                    headers={"Authorization": f"Bearer {self.api_token}"},
+                    verify=self.verify,
+                    timeout=LOGSCALE_PROBE_TIMEOUT_SECONDS,
+                )
+                response.raise_for_status()
+                errors = response.json().get("errors")
+                if errors:
+                    error = "; ".join(e.get("message", str(e)) for e in errors)
+            except Exception as e:
+                error = str(e)
+            self.probed = {
+                "reachable": error is None,
+                "error": error,
+                "latencyMs": round((time.perf_counter() - started) * 1000, 1),
+            }
+            self.probed_at = time.monotonic()
+        finally:
+            self.probe_lock.release()
+
+    def health(self) -> dict:
+        return {
+            **self.probe(),
+            "circuit": self.breaker.state,
+            "inFlight": self.in_flight,
+            "maxConcurrency": self.max_concurrency,
+            "saturated": self.in_flight >= self.max_concurrency,
+        }
+
+    def cache(self, name: str, slot_size: int = None):
+        cache = self.caches.get(name)
+        if cache is None:
+            cache = self.caches[name] = make_cache(f"{self.name}:{name}", slot_size)
+        return cache
+
+    def idle_for(self) -> float:
+        if self.in_flight:
+            return 0.0
+        return time.monotonic() - self.last_used
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close_sync()
+                logging.info(f"Tenant {self.name} disconnected")
+            self.client = None
+            self.session = None
+            for name in self.caches:
+                drop_cache(f"{self.name}:{name}")
+            self.caches.clear()
+        # imported here, the directory module depends on this one
+        from logscalescim.directory import directories
+
+        directories.pop(self.name, None)
+
+
+class TenantRegistry:
+    """Tenant configuration plus the lazily created Tenant objects.
+
+    The "default" tenant comes from LOGSCALE_URL/LOGSCALE_API_TOKEN; more
+    can be listed in the JSON file named by LOGSCALE_TENANTS_FILE::
+
+        {"tenants": {"eu": {"url": "https://eu.example/graphql",
+                            "apiToken": "...", "maxConcurrency": 4,
+                            "weight": 2}}}
+
+    ``weight`` is the tenant's share of LogScale calls when tenants compete
+    for the worker's dispatch slots.
+    """
+
+    def __init__(self, path: str = LOGSCALE_TENANTS_FILE):
+        self.configs = {}
+        if LOGSCALE_URL:
+            self.configs[DEFAULT_TENANT] = {
+                "url": LOGSCALE_URL,
+                "apiToken": LOGSCALE_API_TOKEN,
+            }
+        if path:
+            with open(path) as f:
+                self.configs.update(json.load(f).get("tenants", {}))
+        self.active = {}
+        self.swept = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.configs
+
+    def get(self, name: str = DEFAULT_TENANT) -> Tenant:
+        tenant = self.active.get(name)
+        if tenant is None:
+            with self.lock:
+                tenant = self.active.get(name)
+                if tenant is None:
+                    if name not in self.configs:
+                        raise UnknownTenant(name)
+                    config = self.configs[name]
+                    tenant = Tenant(
+                        name,
+                        config["url"],
+                        config.get("apiToken", ""),
+                        max_concurrency=int(
+                            config.get(
+                                "maxConcurrency", LOGSCALE_TENANT_MAX_CONCURRENCY
+                            )
+                        ),
+                        verify=config.get("verify", False),
+                        weight=float(config.get("weight", 1.0)),
+                    )
+                    self.active[name] = tenant
+        self.evict_idle()
+        return tenant
+
+    def evict_idle(self):
+        now = time.monotonic()
+        if now - self.swept < min(LOGSCALE_TENANT_IDLE_SECONDS, 60):
+            return
+        self.swept = now
+        with self.lock:
+            for name, tenant in list(self.active.items()):
+                if tenant.idle_for() > LOGSCALE_TENANT_IDLE_SECONDS:
+                    del self.active[name]
+                    tenant.close()
+
+    def resolve(self, token, path_tenant: str = None) -> str:
+        """Pick the tenant for a request from its path prefix or SCIM token.
+
+        A token names its tenants with a "tenants" or "tenant" attribute.
+        One without either is bound to the tenant sharing its name, or the
+        default tenant, and may not reach others through the path prefix.
+        """
+        allowed = token.attributes.get("tenants")
+        if allowed is None and "tenant" in token.attributes:
+            allowed = [token.attributes["tenant"]]
+        if allowed is None:
+            allowed = [token.name if token.name in self.configs else DEFAULT_TENANT]
+
+        if path_tenant is not None:
+            name = path_tenant
+        elif allowed:
+            name = allowed[0]
+        else:
+            raise PermissionError(f"token {token.name} may not use any tenant")
+        if name not in allowed:
+            raise PermissionError(f"token {token.name} may not use tenant {name}")
+        return name
+
+
+class TenantPathMiddleware:
+    """Strip a "<prefix>/<tenant>" path segment and record the tenant.
+
+    ``/api/ext/scim/v2/eu/Users`` is served by the normal ``/Users`` routes
+    with ``environ["logscalescim.tenant"] == "eu"``.
+    """
+
+    def __init__(self, wsgi_app, prefix: str, registry: TenantRegistry):
+        self.wsgi_app = wsgi_app
+        self.prefix = prefix.rstrip("/") + "/"
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path.startswith(self.prefix):
+            name, _, rest = path[len(self.prefix) :].partition("/")
+            if rest and name in self.registry:
+                environ["logscalescim.tenant"] = name
+                environ["PATH_INFO"] = self.prefix + rest
+        return self.wsgi_app(environ, start_response)
+
+
+tenants = TenantRegistry()
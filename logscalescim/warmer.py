@@ -0,0 +1,157 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from logscalescim.auth import TokenBucket
+from logscalescim.directory import directories, directory_for
+
+LOGSCALE_WARM = os.environ.get("LOGSCALE_WARM", "true").lower() == "true"
+LOGSCALE_WARM_REFRESH_SECONDS = float(
+    os.environ.get("LOGSCALE_WARM_REFRESH_SECONDS", "900")
+)
+# refreshes are spread by up to this fraction of the interval
+LOGSCALE_WARM_JITTER = float(os.environ.get("LOGSCALE_WARM_JITTER", "0.1"))
+LOGSCALE_WARM_PAGES_PER_SECOND = float(
+    os.environ.get("LOGSCALE_WARM_PAGES_PER_SECOND", "5")
+)
+# the first warm-up of each worker starts within this many seconds
+LOGSCALE_WARM_STARTUP_SPREAD_SECONDS = float(
+    os.environ.get("LOGSCALE_WARM_STARTUP_SPREAD_SECONDS", "5")
+)
+# pages wait while live requests hold this share of a tenant's slots
+LOGSCALE_WARM_YIELD_AT = float(os.environ.get("LOGSCALE_WARM_YIELD_AT", "0.5"))
+
+
+class Warmer(threading.Thread):
+    """Loads the Directory of each tenant in use after fork and refreshes it
+    periodically.
+
+    Pages are rate capped and wait while live requests are using the
+    tenant, so a warm-up never competes with IdP traffic. ``ready`` is set
+    once every tenant was tried; those that failed are retried with backoff
+    and their errors kept in ``errors``.
+    """
+
+    def __init__(self, registry, interval: float = LOGSCALE_WARM_REFRESH_SECONDS):
+        super().__init__(name="logscalescim-warmer", daemon=True)
+        self.registry = registry
+        self.interval = interval
+        self.bucket = TokenBucket(LOGSCALE_WARM_PAGES_PER_SECOND, 1)
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.errors = {}
+
+    def jittered(self, seconds: float) -> float:
+        return seconds * (
+            1 + random.uniform(-LOGSCALE_WARM_JITTER, LOGSCALE_WARM_JITTER)
+        )
+
+    def pace(self, tenant):
+        def wait():
+            while not self.stopped.is_set():
+                if tenant.in_flight >= tenant.max_concurrency * LOGSCALE_WARM_YIELD_AT:
+                    self.stopped.wait(0.1)
+                    continue
+                delay = self.bucket.take()
+                if not delay:
+                    return
+                self.stopped.wait(delay)
+            raise InterruptedError("warmer stopped")
+
+        return wait
+
+    def warm(self, names) -> list:
+        """Load the directories of the named tenants, returns those that failed.
+
+        Tenants no longer in use are skipped rather than created again.
+        """
+        failed = []
+        for name in names:
+            tenant = self.registry.active.get(name)
+            if tenant is None:
+                self.errors.pop(name, None)
+                continue
+            started = time.monotonic()
+            try:
+                directory_for(tenant).load(tenant, pace=self.pace(tenant))
+                self.errors.pop(name, None)
+                logging.info(
+                    f"Warmed tenant {name} in {time.monotonic() - started:.1f}s"
+                )
+            except InterruptedError:
+                raise
+            except Exception as e:
+                logging.exception(f"Warming tenant {name} failed")
+                self.errors[name] = str(e)
+                failed.append(name)
+        return failed
+
+    def run(self):
+        # workers forked together would otherwise all page LogScale at once
+        delay = random.uniform(0, LOGSCALE_WARM_STARTUP_SPREAD_SECONDS)
+        retry = 5.0
+        refresh_at = 0.0
+        failed = []
+        while not self.stopped.wait(delay):
+            if time.monotonic() >= refresh_at:
+                names = list(self.registry.active)
+                refresh_at = time.monotonic() + self.jittered(self.interval)
+            else:
+                names = failed
+            try:
+                failed = self.warm(names)
+            except InterruptedError:
+                return
+            # ready once every tenant was tried, one tenant's LogScale being
+            # down must not keep the worker out of rotation for the others
+            self.ready.set()
+            remaining = max(0.0, refresh_at - time.monotonic())
+            if failed:
+                # retry the failed tenants sooner than the refresh interval
+                delay = min(retry, remaining)
+                retry = min(retry * 2, self.interval)
+            else:
+                retry = 5.0
+                delay = remaining
+
+    def stop(self):
+        self.stopped.set()
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready.is_set(),
+            "errors": dict(self.errors),
+            "loaded": {
+                name: directory.loaded_at for name, directory in directories.items()
+            },
+        }
+
+
+_warmer = None
+
+
+def start_warmer(registry):
+    """Start the warmer once per process, when enabled."""
+    global _warmer
+    if not LOGSCALE_WARM:
+        return None
+    if _warmer is None or not _warmer.is_alive():
+        _warmer = Warmer(registry)
+        _warmer.start()
+    return _warmer
+
+
+def warm_errors() -> dict:
+    """The last warm-up error of each tenant that has not loaded since."""
+    if _warmer is None:
+        return {}
+    return dict(_warmer.errors)
+
+
+def warmed() -> bool:
+    """Whether every tenant was tried once; always true when warming is disabled."""
+    if not LOGSCALE_WARM:
+        return True
+    return _warmer is not None and _warmer.ready.is_set()
@@ -0,0 +1,196 @@
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from logscalescim import cache
+from logscalescim.cache import (
+    Cache,
+    InvalidationChannel,
+    LRUCache,
+    MemcacheCache,
+    MemcacheStandIn,
+    MmapCache,
+    UdpInvalidationChannel,
+)
+
+
+def invalidating(channel, *backends):
+    """Subscribe backends to a channel the way make_cache does."""
+
+    def invalidate(action, key):
+        for backend in backends:
+            if action == "del":
+                backend.delete(key)
+            elif action == "clr":
+                backend.clear(key)
+
+    channel.subscribe(invalidate)
+    return channel
+
+
+def eventually(check, timeout: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return True
+        time.sleep(0.01)
+    return check()
+
+
+class BackendTests:
+    """Run against every backend; two instances stand for two workers."""
+
+    def make_pair(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.first, self.second = self.make_pair()
+
+    def test_delete_is_seen_by_the_other_worker(self):
+        channel = invalidating(InvalidationChannel(), self.first, self.second)
+        writer = Cache("t:users", self.first, channel)
+        reader = Cache("t:users", self.second, channel)
+        # each worker looked the user up and cached it
+        writer.remember("alice@example.com", "U1")
+        reader.remember("alice@example.com", "U1")
+        writer.forget("U1")
+        self.assertIsNone(reader.get("alice@example.com"))
+        self.assertIsNone(reader.get("id:U1"))
+
+    def test_clear_drops_only_the_namespace(self):
+        channel = invalidating(InvalidationChannel(), self.first, self.second)
+        for backend in (self.first, self.second):
+            Cache("t:users", backend, channel).set("a", 1)
+            Cache("t:groups", backend, channel).set("b", 2)
+        Cache("t:users", self.first, channel).clear()
+        self.assertIsNone(Cache("t:users", self.second, channel).get("a"))
+        self.assertEqual(Cache("t:groups", self.second, channel).get("b"), 2)
+
+    def test_add_only_succeeds_once(self):
+        self.assertTrue(self.first.add("claim", {"owner": "a"}, ttl=60))
+        self.assertFalse(self.second.add("claim", {"owner": "b"}, ttl=60))
+        self.assertEqual(self.second.get("claim"), {"owner": "a"})
+        self.first.delete("claim")
+        self.assertTrue(self.second.add("claim", {"owner": "b"}, ttl=60))
+
+    def test_add_replaces_an_expired_entry(self):
+        self.first.set("claim", {"owner": "a"}, ttl=1)
+        self.assertTrue(eventually(lambda: self.second.get("claim") is None, 3))
+        self.assertTrue(self.second.add("claim", {"owner": "b"}, ttl=60))
+
+
+class LRUTests(BackendTests, unittest.TestCase):
+    def make_pair(self):
+        # one lru per worker, kept in step by the channel alone
+        return LRUCache(), LRUCache()
+
+    def test_add_only_succeeds_once(self):
+        backend = self.first
+        self.assertTrue(backend.add("claim", {"owner": "a"}, ttl=60))
+        self.assertFalse(backend.add("claim", {"owner": "b"}, ttl=60))
+
+    def test_add_replaces_an_expired_entry(self):
+        self.first.set("claim", {"owner": "a"}, ttl=0.01)
+        time.sleep(0.02)
+        self.assertTrue(self.first.add("claim", {"owner": "b"}, ttl=60))
+
+    def test_dropped_namespace_frees_its_backend(self):
+        with mock.patch.multiple(cache, LOGSCALE_CACHE_BACKEND="lru", _backends={}):
+            cache.make_cache("t:users").set("a", 1)
+            cache.make_cache("t:groups").set("b", 2)
+            cache.drop_cache("t:users")
+            self.assertEqual(list(cache._backends), ["t:groups"])
+            self.assertIsNone(cache.make_cache("t:users").get("a"))
+
+
+class MmapTests(BackendTests, unittest.TestCase):
+    def make_pair(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+        return MmapCache(path, slots=64), MmapCache(path, slots=64)
+
+    def test_oversize_value_drops_the_old_one(self):
+        self.first.set("k", {"state": "pending"})
+        self.first.set("k", {"body": "x" * self.first.slot_size})
+        self.assertIsNone(self.second.get("k"))
+
+    def test_oversize_add_claims_nothing(self):
+        with self.assertRaises(ValueError):
+            self.first.add("claim", {"body": "x" * self.first.slot_size})
+        self.assertTrue(self.second.add("claim", {"owner": "b"}, ttl=60))
+
+    def test_large_slots_get_a_file_of_their_own(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+        with mock.patch.multiple(
+            cache,
+            LOGSCALE_CACHE_BACKEND="mmap",
+            LOGSCALE_CACHE_MMAP_PATH=path,
+            _backends={},
+        ):
+            small = cache.make_cache("t:users")
+            large = cache.make_cache("t:idempotency", slot_size=4096)
+            self.addCleanup(os.unlink, f"{path}.4096")
+            entry = {"status": 200, "body": "x" * 2048}
+            large.set("k", entry)
+            small.set("k", entry)
+            self.assertEqual(large.get("k"), entry)
+            self.assertIsNone(small.get("k"))
+            self.assertIs(
+                cache.make_cache("t:other", slot_size=4096).backend, large.backend
+            )
+
+
+class MemcacheTests(BackendTests, unittest.TestCase):
+    def make_pair(self):
+        server = MemcacheStandIn(("127.0.0.1", 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        address = "%s:%d" % server.server_address
+        return MemcacheCache(address), MemcacheCache(address)
+
+    def test_clear_drops_only_the_namespace(self):
+        self.skipTest("memcached cannot enumerate keys, cleared entries expire")
+
+    def test_clear_leaves_other_namespaces(self):
+        channel = invalidating(InvalidationChannel(), self.first, self.second)
+        Cache("t:groups", self.second, channel).set("b", 2)
+        Cache("t:users", self.first, channel).clear()
+        self.assertEqual(Cache("t:groups", self.second, channel).get("b"), 2)
+
+    def test_unreachable_server_is_a_miss(self):
+        cache = MemcacheCache("127.0.0.1:1")
+        self.assertIsNone(cache.get("k"))
+        self.assertTrue(cache.add("k", 1))
+
+
+class UdpInvalidationTests(unittest.TestCase):
+    def setUp(self):
+        port = random.randint(20000, 40000)
+        self.channels = [UdpInvalidationChannel("239.255.42.99", port) for _ in "ab"]
+        self.backends = [LRUCache(), LRUCache()]
+        for channel, backend in zip(self.channels, self.backends):
+            invalidating(channel, backend)
+            channel.start()
+        if any(channel.out is None for channel in self.channels):
+            self.skipTest("multicast is not available here")
+
+    def test_delete_reaches_a_worker_that_never_published(self):
+        first, second = (
+            Cache("t:users", backend, channel)
+            for backend, channel in zip(self.backends, self.channels)
+        )
+        first.set("alice@example.com", "U1")
+        second.set("alice@example.com", "U1")
+        first.delete("alice@example.com")
+        self.assertIsNone(first.get("alice@example.com"))
+        self.assertTrue(eventually(lambda: second.get("alice@example.com") is None))
+
+
+if __name__ == "__main__":
+    unittest.main()
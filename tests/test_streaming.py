@@ -0,0 +1,137 @@
+import io
+import json
+import time
+import types
+import unittest
+
+from logscalescim.streaming import (
+    JsonReader,
+    StreamError,
+    iter_patch_operations,
+    read_group,
+)
+
+
+def operations(body: dict):
+    """Run a PatchOp body through the reader, listing streamed values."""
+    stream = io.BytesIO(json.dumps(body).encode())
+    result = []
+    for operation in iter_patch_operations(stream):
+        value = operation.get("value")
+        if isinstance(value, types.GeneratorType):
+            operation = {**operation, "value": list(value), "streamed": True}
+        result.append(operation)
+    return result
+
+
+class ReaderTests(unittest.TestCase):
+    def reader(self, text: str, chunk_size: int = 3) -> JsonReader:
+        return JsonReader(io.BytesIO(text.encode()), chunk_size=chunk_size)
+
+    def test_values_crossing_chunk_boundaries(self):
+        document = {
+            "name": "Grüße 名前 🎉" * 5,
+            "count": 1234567890123,
+            "ratio": -12.5e-3,
+            "flags": [True, False, None],
+            "nested": {"a": [1, {"b": "c"}]},
+        }
+        text = json.dumps(document, ensure_ascii=False)
+        for chunk_size in (1, 2, 3, 5, 64):
+            reader = self.reader(text, chunk_size)
+            self.assertEqual({key: reader.value() for key in reader.keys()}, document)
+            self.assertEqual(reader.peek(), "")
+
+    def test_number_at_the_end_of_a_chunk(self):
+        reader = self.reader("[12345, 6]", chunk_size=3)
+        self.assertEqual(list(reader.items()), [12345, 6])
+
+    def test_truncated_bodies(self):
+        text = json.dumps({"Operations": [{"op": "add", "value": ["abc", 1.5]}]})
+        for cut in range(1, len(text)):
+            with self.subTest(body=text[:cut]):
+                with self.assertRaises(StreamError):
+                    reader = self.reader(text[:cut])
+                    for _ in reader.keys():
+                        reader.value()
+
+    def test_large_value_is_read_in_linear_time(self):
+        def elapsed(count):
+            text = json.dumps([{"value": f"user-{i:08d}"} for i in range(count)])
+            reader = self.reader(text, chunk_size=1024)
+            start = time.perf_counter()
+            self.assertEqual(len(reader.value()), count)
+            return time.perf_counter() - start
+
+        small, large = elapsed(20000), elapsed(160000)
+        # 8x the data; a reader that re-decodes per chunk takes ~64x
+        self.assertLess(large, small * 24 + 0.05)
+
+
+class PatchOperationTests(unittest.TestCase):
+    members = [{"value": f"U{i}"} for i in range(20)]
+
+    def test_members_are_streamed_when_op_and_path_come_first(self):
+        body = {
+            "Operations": [
+                {"op": "add", "path": "members", "value": self.members},
+                {"op": "replace", "path": "displayName", "value": "ops"},
+            ]
+        }
+        first, second = operations(body)
+        self.assertTrue(first["streamed"])
+        self.assertEqual(first["value"], self.members)
+        self.assertEqual(second, body["Operations"][1])
+
+    def test_value_before_path_is_decoded_whole(self):
+        body = {"Operations": [{"op": "add", "value": self.members, "path": "members"}]}
+        (operation,) = operations(body)
+        self.assertNotIn("streamed", operation)
+        self.assertEqual(operation, body["Operations"][0])
+
+    def test_op_after_value_is_decoded_whole(self):
+        body = {
+            "Operations": [{"path": "members", "value": self.members, "op": "remove"}]
+        }
+        (operation,) = operations(body)
+        self.assertNotIn("streamed", operation)
+        self.assertEqual(operation["op"], "remove")
+        self.assertEqual(operation["value"], self.members)
+
+    def test_unconsumed_members_are_skipped(self):
+        body = {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:PatchOp"],
+            "Operations": [
+                {"op": "add", "path": "members", "value": self.members},
+                {"op": "remove", "path": "members", "value": self.members[:1]},
+            ],
+        }
+        stream = io.BytesIO(json.dumps(body).encode())
+        ops = [operation["op"] for operation in iter_patch_operations(stream)]
+        self.assertEqual(ops, ["add", "remove"])
+
+    def test_truncated_members_raise(self):
+        text = json.dumps(
+            {"Operations": [{"op": "add", "path": "members", "value": self.members}]}
+        )
+        stream = io.BytesIO(text[: len(text) // 2].encode())
+        with self.assertRaises(StreamError):
+            for operation in iter_patch_operations(stream):
+                list(operation["value"])
+
+
+class ReadGroupTests(unittest.TestCase):
+    def test_members_are_reduced_to_ids(self):
+        body = {
+            "displayName": "ops",
+            "members": [{"value": "U1", "display": "a"}, {"value": "U2"}],
+            "externalId": "x",
+        }
+        group = read_group(io.BytesIO(json.dumps(body).encode()))
+        self.assertEqual(
+            group, {"displayName": "ops", "members": {"U1", "U2"}, "externalId": "x"}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()